@@ -1,13 +1,27 @@
 import connexion
 from connexion import FlaskApp
+from flask import Response
 from flask_cors import CORS, cross_origin
 
 import os 
+import sys
 import yaml 
-import json 
-import logging
-import logging.config
-from pykafka import KafkaClient
+import random
+from threading import Thread
+
+from audit_index import AuditIndex
+from snapshot_stream import SnapshotStream
+from response_validator import sampled_response_validator
+from broker import connect, OffsetType
+from event_codec import decode_message
+from metrics import init_metrics
+from log_setup import setup_logging
+from prometheus_client import Histogram, Gauge
+
+# connexion imports the module of the operationIds (app) by name. Run as python3 app.py, this module is __main__,
+# so without this alias it would be imported and run a second time (connecting and registering its metrics twice)
+if __name__ == "__main__":
+    sys.modules["app"] = sys.modules[__name__]
 
 # with open('app_conf.yml', 'r') as f: 
 #     app_config = yaml.safe_load(f.read())
@@ -34,74 +48,143 @@ with open(app_conf_file, 'r') as f:
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f.read())
 
-logging.config.dictConfig(log_config)
-logger = logging.getLogger('basicLogger')
-logger.info("App Conf File: %s" % app_conf_file)
-logger.info("Log Conf File: %s" % log_conf_file)
+# Handlers run on a background thread (log_setup.py), so logging calls do not wait for the disk
+logger = setup_logging(log_config)
+logger.info("App Conf File: %s", app_conf_file)
+logger.info("Log Conf File: %s", log_conf_file)
+
+
+AUDIT_INDEX = AuditIndex(app_config["datastore"]["filename"])
+
+# Each lookup is a primary key read of the index, so this stays at 0 or 1 rows instead of a scan of the topic
+ROWS_SCANNED = Histogram("audit_rows_scanned", "Index rows read per audit lookup", ["event_type"], buckets=(0, 1, 10, 100, 1000, 10000))
+INDEXED_EVENTS = Gauge("audit_indexed_events", "Events in the audit index", ["event_type"])
+for indexed_type in ["hotel_room", "hotel_activity"]:
+    INDEXED_EVENTS.labels(indexed_type).set_function(lambda event_type=indexed_type: AUDIT_INDEX.count(event_type))
+
+
+def audit_snapshot(event_type):
+    """ A random indexed event of the type and its index, which changes whenever events were indexed """
+    count = AUDIT_INDEX.count(event_type)
+    if count == 0:
+        return {"message": "Not Found"}, 404, None
+
+    index = random.randrange(count)
+    return {"index": index, "event": get_event(event_type, index)}, 200, '"%d-%d"' % (count, index)
+
+
+# Pushed to the subscribers of /booking/hotel-rooms/stream and /booking/hotel-activities/stream after every index commit
+AUDIT_STREAMS = {event_type: SnapshotStream(lambda event_type=event_type: audit_snapshot(event_type),
+                                            app_config.get("push", {}).get("heartbeat_sec", 15))
+                 for event_type in ["hotel_room", "hotel_activity"]}
+
+
+def index_messages():
+    """ 
+    Keeps the audit index up to date 
+
+    - Connect to the broker 
+    - Consume the events topic from the beginning on first start, then resume from the committed offset
+    - Record each message under the next ordinal for its type so lookups by index never replay the topic
+    """
+
+    topic = connect(app_config["events"], logger, lambda client: client.topics[str.encode(app_config["events"]["topic"])])
+
+    # The index is persistent, so only messages that were not indexed before the last restart are read. 
+    # A brand-new consumer group starts from the beginning of the topic so the history is indexed once.
+    consumer = topic.get_simple_consumer(consumer_group=b'audit_group',
+                                         reset_offset_on_start=False,
+                                         auto_offset_reset=OffsetType.EARLIEST,
+                                         consumer_timeout_ms=1000)
+
+    pending = 0
+    while True:
+        msg = consumer.consume()
+
+        if msg is not None:
+            # The message is indexed as it was written, in either wire format (event_codec.py)
+            event = decode_message(msg.value)
+            AUDIT_INDEX.add(event["type"], msg.partition_id, msg.offset, msg.value)
+            pending += 1
+
+        # Commit when the topic goes idle or every 100 messages during a catch-up.
+        # The index is committed before the offset so a crash in between only re-reads (and skips) the same messages.
+        if pending and (msg is None or pending >= 100):
+            AUDIT_INDEX.commit()
+            consumer.commit_offsets()
+            pending = 0
+
+            for stream in AUDIT_STREAMS.values():
+                stream.refresh()
+
+
+def get_event(event_type, index):
+    """ Looks up the event of the given type at the index in the audit index """
+    if index < 0:
+        index += AUDIT_INDEX.count(event_type)
+    if index < 0:
+        return None
+
+    message = AUDIT_INDEX.get(event_type, index)
+    ROWS_SCANNED.labels(event_type).observe(0 if message is None else 1)
+    if message is None:
+        return None
+    return decode_message(message)
 
 
 def get_hotel_room(index):
     """ Get Hotel Room reservations in History """
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-
-    # Here we reset the offset on start so that we retrieve messages at the beginning of the message queue.
-    # To prevent the for loop from blocking, we set the timeout to 100ms. 
-    # There is a risk that this loop never stops if the index is large and messages are constantly being received!
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=2000)
-    logger.info("Retrieving Hotel Room at index %d" % index)
-    hotel_room_list = []
-    try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            # Find the event at the index you want and return code 200 i.e., return event, 200
-            if msg["type"] == "hotel_room":
-                hotel_room_list.append(msg)
-
-        logger.info(f"Hotel Room in {index}: {hotel_room_list[index]}")
-        return hotel_room_list[index], 200
-    except:
-        logger.error("No more messages found")
-
-    logger.error("Could not find Hotel Room at index %d" % index)
+    logger.info("Retrieving Hotel Room at index %d", index)
+
+    hotel_room = get_event("hotel_room", index)
+    if hotel_room is not None:
+        logger.info("Hotel Room in %d: %s", index, hotel_room)
+        return hotel_room, 200
+
+    logger.error("Could not find Hotel Room at index %d", index)
     return {"message": "Not Found"}, 404
 
 def get_hotel_activity(index):
     """ Get Hotel Activity reservations in History """
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname) 
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-
-    # Here we reset the offset on start so that we retrieve messages at the beginning of the message queue.
-    # To prevent the for loop from blocking, we set the timeout to 100ms. 
-    # There is a risk that this loop never stops if the index is large and messages are constantly being received!
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=2000)
-    logger.info("Retrieving Hotel Activity at index %d" % index)
-    hotel_activity_list = []
-    try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            # Find the event at the index you want and return code 200 i.e., return event, 200
-            if msg["type"] == "hotel_activity":
-                hotel_activity_list.append(msg)
-
-        logger.info(f"Hotel Activity in {index}: {hotel_activity_list[index]}")
-        return hotel_activity_list[index], 200
-    except:
-        logger.error("No more messages found")
-
-    logger.error("Could not find Hotel Activity at index %d" % index)
+    logger.info("Retrieving Hotel Activity at index %d", index)
+
+    hotel_activity = get_event("hotel_activity", index)
+    if hotel_activity is not None:
+        logger.info("Hotel Activity in %d: %s", index, hotel_activity)
+        return hotel_activity, 200
+
+    logger.error("Could not find Hotel Activity at index %d", index)
     return {"message": "Not Found"}, 404
 
+def stream_events(event_type, name):
+    """ Streams random events of a type as Server-Sent Events, pushing a new one every time events were indexed """
+
+    logger.info("Streaming %s events", name)
+
+    return Response(AUDIT_STREAMS[event_type].events(connexion.request.headers.get("Last-Event-ID")),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def get_hotel_room_stream():
+    """ Streams Hotel Room reservations in History """
+    return stream_events("hotel_room", "Hotel Room")
+
+def get_hotel_activity_stream():
+    """ Streams Hotel Activity reservations in History """
+    return stream_events("hotel_activity", "Hotel Activity")
+
 
 app = connexion.FlaskApp(__name__, specification_dir="")
-app.add_api("openapi.yaml", strict_validation=True, validate_responses=True) 
+# The validator passes the event streams through, validating them would wait for the end of the stream
+api = app.add_api("openapi.yaml", strict_validation=True, validate_responses=True,
+                  validator_map={"response": sampled_response_validator(app_config.get("response_validation", {}))}) 
+init_metrics(app, api)
 
 CORS(app.app)
 app.app.config["CORS_HEADERS"] = "Content-Type"
 
 if __name__ == "__main__":
+    t1 = Thread(target=index_messages)
+    t1.setDaemon(True)
+    t1.start()
     app.run(host="0.0.0.0", port=8110)
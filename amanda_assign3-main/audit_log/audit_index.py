@@ -0,0 +1,56 @@
+import sqlite3
+import threading
+
+
+class AuditIndex:
+    """ On-disk index of the events topic: (event type, ordinal) -> Kafka partition/offset and message """
+
+    def __init__(self, filename):
+        """ Opens (or creates) the SQLite index file and loads the per-type counters """
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+
+        self.conn.execute('''
+                          CREATE TABLE IF NOT EXISTS event_index
+                          (event_type VARCHAR(50) NOT NULL,
+                           ordinal INTEGER NOT NULL,
+                           partition_id INTEGER NOT NULL,
+                           kafka_offset INTEGER NOT NULL,
+                           message BLOB NOT NULL,
+                           PRIMARY KEY (event_type, ordinal),
+                           UNIQUE (partition_id, kafka_offset))
+                          ''')
+        self.conn.commit()
+
+        # Next ordinal to hand out for each event type
+        self.counts = {}
+        for event_type, max_ordinal in self.conn.execute("SELECT event_type, MAX(ordinal) FROM event_index GROUP BY event_type"):
+            self.counts[event_type] = max_ordinal + 1
+
+    def add(self, event_type, partition_id, kafka_offset, message):
+        """ Indexes one message. Messages that are already indexed (e.g. redelivered after a restart) are skipped """
+        with self.lock:
+            ordinal = self.counts.get(event_type, 0)
+            cursor = self.conn.execute("INSERT OR IGNORE INTO event_index (event_type, ordinal, partition_id, kafka_offset, message) VALUES (?, ?, ?, ?, ?)",
+                                       (event_type, ordinal, partition_id, kafka_offset, message))
+            if cursor.rowcount:
+                self.counts[event_type] = ordinal + 1
+
+    def commit(self):
+        """ Makes the indexed messages durable """
+        with self.lock:
+            self.conn.commit()
+
+    def get(self, event_type, ordinal):
+        """ Returns the raw message stored at the ordinal for the event type (bytes, or text when it was indexed before the compact format), or None """
+        with self.lock:
+            row = self.conn.execute("SELECT message FROM event_index WHERE event_type = ? AND ordinal = ?",
+                                    (event_type, ordinal)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def count(self, event_type):
+        """ Number of indexed messages for the event type """
+        with self.lock:
+            return self.counts.get(event_type, 0)
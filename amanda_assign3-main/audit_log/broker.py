@@ -0,0 +1,369 @@
+"""
+Message broker backends shared by the services
+
+events.backend selects the broker in app_conf.yml:
+
+- kafka (default): pykafka.KafkaClient connected to events.hostname:events.port
+- local: every topic partition is an append-only log file under events.log_dir, with committed offsets per
+  consumer group next to it. Services on one machine (or in one process) share the topics through that
+  directory, so no Kafka broker or network hop is needed.
+
+Both backends have the pykafka interface the services use: client.topics[name], get_sync_producer /
+get_producer, get_simple_consumer, consume(), commit_offsets(), reset_offsets() and delivery reports.
+Producers are created with make_producer(), so the producer section of app_conf.yml applies to all of them.
+"""
+import os
+import json
+import time
+import zlib
+import queue
+import fcntl
+import random
+import struct
+import threading
+
+
+class OffsetType:
+    """ Same values as pykafka.common.OffsetType, so both backends accept them """
+    EARLIEST = -2
+    LATEST = -1
+
+
+# Same values as pykafka.common.CompressionType
+COMPRESSION_TYPES = {"none": 0, "gzip": 1, "snappy": 2, "lz4": 3}
+
+
+def random_partitioner(partitions, key):
+    """ Any partition (pykafka's default) """
+    return random.choice(partitions)
+
+
+def hashing_partitioner(partitions, key):
+    """ The same key always goes to the same partition, in every process (unlike hash(), crc32 is not salted) """
+    if key is None:
+        return random_partitioner(partitions, key)
+    return partitions[zlib.crc32(key) % len(partitions)]
+
+
+def get_client(events_config):
+    """ Client of the configured broker backend """
+    if events_config.get("backend", "kafka") == "local":
+        return LocalClient(events_config["log_dir"],
+                           events_config.get("partitions", {}),
+                           events_config.get("poll_ms", 10))
+
+    # Only the kafka backend needs pykafka.
+    # From broker_version 0.10.0 on, lz4 messages have the framing current brokers expect (older ones need xxhash).
+    from pykafka import KafkaClient
+    return KafkaClient(hosts="%s:%d" % (events_config["hostname"], events_config["port"]),
+                       broker_version=events_config.get("broker_version", "0.9.0"))
+
+
+def make_producer(topic, producer_config=None, sync=True, **kwargs):
+    """
+    Producer of a topic with the settings of the producer section of app_conf.yml. Every producer is created here.
+
+    - compression: none (default), gzip, snappy (needs python-snappy) or lz4 (needs lz4)
+    - batch_size: messages an async producer sends per request (default 500)
+    - linger_ms: how long an async producer waits for a batch to fill up (default 5)
+    - required_acks: 0 (no ack), 1 (the partition leader, default) or -1 (every in-sync replica)
+
+    A sync producer sends every message on its own and only uses required_acks: a single message gets larger when
+    compressed (see the receiver's benchmark_compression.py), so it is always sent uncompressed. Other keyword
+    arguments (partitioner, delivery_reports, ...) go to the producer as they are. The local backend accepts the
+    same settings, and stores the messages uncompressed.
+    """
+    producer_config = producer_config or {}
+
+    compression = producer_config.get("compression", "none")
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError("Unknown compression %s, expected one of %s" % (compression, ", ".join(COMPRESSION_TYPES)))
+
+    kwargs["required_acks"] = producer_config.get("required_acks", 1)
+
+    if sync:
+        return topic.get_sync_producer(**kwargs)
+
+    kwargs["compression"] = COMPRESSION_TYPES[compression]
+    kwargs["min_queued_messages"] = producer_config.get("batch_size", 500)
+    kwargs["linger_ms"] = producer_config.get("linger_ms", 5)
+    return topic.get_producer(**kwargs)
+
+
+def connect(events_config, logger, setup=None):
+    """
+    Connects to the configured broker, retrying up to events.max_retries times
+
+    setup(client) runs as part of each attempt (e.g. to look up topics and create producers) and its result is
+    returned. Without setup the client itself is returned. Returns None when every attempt failed.
+    """
+    current_retry = 0
+    max_retries = events_config.get("max_retries", 5)
+
+    while current_retry < max_retries:
+        try:
+            logger.info("Trying to connect to the %s broker. Current retry count: %d", events_config.get("backend", "kafka"), current_retry)
+            client = get_client(events_config)
+            return setup(client) if setup is not None else client
+        except:
+            logger.error("Connection failed.")
+            time.sleep(events_config.get("sleep_time", 5))
+            current_retry += 1
+
+    return None
+
+
+# Log record: key length, value length, timestamp (ms), then the key and value bytes.
+# The index file holds the log position of every offset, so a message is found without scanning the log.
+RECORD_HEADER = struct.Struct(">IIq")
+INDEX_ENTRY = struct.Struct(">Q")
+
+
+class LocalMessage:
+    """ A message read from a local log, with the attributes of a pykafka message """
+
+    def __init__(self, value, partition_key, partition_id, offset, timestamp):
+        """ Initializes a message """
+        self.value = value
+        self.partition_key = partition_key
+        self.partition_id = partition_id
+        self.offset = offset
+        self.timestamp = timestamp
+
+
+class LocalPartition:
+    """ Append-only log and index files of one partition """
+
+    def __init__(self, topic, partition_id):
+        """ Opens (or creates) the partition files """
+        self.topic = topic
+        self.id = partition_id
+        self.lock = threading.Lock()
+        path = os.path.join(topic.path, "%d" % partition_id)
+        self.log_file = open(path + ".log", 'ab')
+        self.index_file = open(path + ".index", 'ab')
+        self.log_fd = os.open(path + ".log", os.O_RDONLY)
+        self.index_fd = os.open(path + ".index", os.O_RDONLY)
+
+    def append(self, partition_key, value):
+        """ Appends a message and returns its offset """
+        key = partition_key or b""
+        record = RECORD_HEADER.pack(len(key), len(value), int(time.time() * 1000)) + key + value
+
+        # flock serializes writers in other processes, the lock writers in this one
+        with self.lock:
+            fcntl.flock(self.index_file, fcntl.LOCK_EX)
+            try:
+                self.log_file.seek(0, os.SEEK_END)
+                position = self.log_file.tell()
+                self.log_file.write(record)
+                self.log_file.flush()
+                # A message becomes visible to consumers once its index entry is written
+                self.index_file.write(INDEX_ENTRY.pack(position))
+                self.index_file.flush()
+                return self.index_file.tell() // INDEX_ENTRY.size - 1
+            finally:
+                fcntl.flock(self.index_file, fcntl.LOCK_UN)
+
+    def latest_offset(self):
+        """ Offset the next appended message will get """
+        return os.fstat(self.index_fd).st_size // INDEX_ENTRY.size
+
+    def read(self, offset):
+        """ Reads the message at an offset """
+        position, = INDEX_ENTRY.unpack(os.pread(self.index_fd, INDEX_ENTRY.size, offset * INDEX_ENTRY.size))
+        key_length, value_length, timestamp = RECORD_HEADER.unpack(os.pread(self.log_fd, RECORD_HEADER.size, position))
+        data = os.pread(self.log_fd, key_length + value_length, position + RECORD_HEADER.size)
+        return LocalMessage(data[key_length:], data[:key_length] or None, self.id, offset, timestamp)
+
+
+class LocalTopic:
+    """ A topic directory with one log per partition and the committed offsets of its consumer groups """
+
+    def __init__(self, client, name, num_partitions):
+        """ Opens the topic, creating it with num_partitions partitions if it does not exist yet """
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.log_dir, name.decode('utf-8'))
+        os.makedirs(os.path.join(self.path, "offsets"), exist_ok=True)
+
+        # The first process to open the topic fixes its number of partitions
+        meta_path = os.path.join(self.path, "partitions")
+        temp_path = "%s.%d.%d" % (meta_path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'w') as f:
+            f.write("%d" % num_partitions)
+        try:
+            os.link(temp_path, meta_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+        with open(meta_path, 'r') as f:
+            num_partitions = int(f.read())
+
+        self.partitions = {partition_id: LocalPartition(self, partition_id) for partition_id in range(num_partitions)}
+
+    def committed_offsets(self, consumer_group):
+        """ Last committed offset of each partition for a consumer group """
+        try:
+            with open(os.path.join(self.path, "offsets", "%s.json" % consumer_group.decode('utf-8')), 'r') as f:
+                return {int(partition_id): offset for partition_id, offset in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+
+    def commit_offsets(self, consumer_group, offsets):
+        """ Merges offsets into the committed offsets of a consumer group """
+        path = os.path.join(self.path, "offsets", "%s.json" % consumer_group.decode('utf-8'))
+
+        # Consumers of the same group in other processes may be committing other partitions at the same time
+        with open(path + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            committed = self.committed_offsets(consumer_group)
+            committed.update(offsets)
+            temp_path = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+            with open(temp_path, 'w') as f:
+                json.dump(committed, f)
+            os.replace(temp_path, path)
+
+    def get_sync_producer(self, **kwargs):
+        """ Producer whose produce() returns once the message is in the log """
+        return LocalProducer(self, **kwargs)
+
+    def get_producer(self, **kwargs):
+        """ Appending to the log is already cheap, so the async producer is the same """
+        return LocalProducer(self, **kwargs)
+
+    def get_simple_consumer(self, consumer_group=None, **kwargs):
+        """ Consumer of the given partitions (default: all of them) """
+        return LocalConsumer(self, consumer_group, **kwargs)
+
+    def get_balanced_consumer(self, consumer_group, **kwargs):
+        """ The local backend has no group coordinator, so a balanced consumer is a configuration error """
+        raise ValueError("events.backend local cannot balance the consumers of group %s (events.zookeeper is only used "
+                         "with the kafka backend): assign partitions with get_simple_consumer(partitions=...)"
+                         % consumer_group.decode('utf-8'))
+
+
+class LocalProducer:
+    """ Producer with pykafka's produce() and delivery report interface """
+
+    def __init__(self, topic, partitioner=None, delivery_reports=False, **kwargs):
+        """ Initializes a producer """
+        self.topic = topic
+        self.partitioner = partitioner or random_partitioner
+        self.delivery_reports = delivery_reports
+        self.reports = queue.Queue()
+
+    def produce(self, message, partition_key=None):
+        """ Appends a message to the partition chosen by the partitioner """
+        partition = self.partitioner(list(self.topic.partitions.values()), partition_key)
+        offset = partition.append(partition_key, message)
+        if self.delivery_reports:
+            self.reports.put((LocalMessage(message, partition_key, partition.id, offset, None), None))
+
+    def get_delivery_report(self, block=False, timeout=None):
+        """ (message, exception) of a produced message. Raises queue.Empty when there is none """
+        return self.reports.get(block, timeout)
+
+    def stop(self):
+        """ Nothing is buffered """
+
+
+class LocalConsumer:
+    """ Consumer with pykafka's consume(), commit_offsets() and reset_offsets() interface """
+
+    def __init__(self, topic, consumer_group=None, partitions=None, auto_offset_reset=OffsetType.EARLIEST,
+                 reset_offset_on_start=False, consumer_timeout_ms=-1, auto_commit_enable=False, **kwargs):
+        """ Starts each partition after its committed offset, or at auto_offset_reset when there is none """
+        self.topic = topic
+        self.consumer_group = consumer_group
+        self.timeout_sec = None if consumer_timeout_ms is None or consumer_timeout_ms < 0 else consumer_timeout_ms / 1000.0
+        self.auto_commit_enable = auto_commit_enable
+        self.poll_sec = topic.client.poll_ms / 1000.0
+
+        partitions = list(topic.partitions.values()) if partitions is None else list(partitions)
+        committed = {} if consumer_group is None or reset_offset_on_start else topic.committed_offsets(consumer_group)
+
+        # Offset of the next message to read from each partition
+        self.positions = {}
+        for partition in partitions:
+            if partition.id in committed:
+                self.positions[partition.id] = committed[partition.id] + 1
+            elif auto_offset_reset == OffsetType.LATEST:
+                self.positions[partition.id] = partition.latest_offset()
+            else:
+                self.positions[partition.id] = 0
+
+        self.consumed = {}
+
+    def _next_message(self):
+        """ The next unread message of any partition, or None """
+        for partition_id, position in self.positions.items():
+            partition = self.topic.partitions[partition_id]
+            if position < partition.latest_offset():
+                self.positions[partition_id] = position + 1
+                self.consumed[partition_id] = position
+                return partition.read(position)
+        return None
+
+    def consume(self, block=True):
+        """ Returns the next message, or None once consumer_timeout_ms passed without one """
+        deadline = None if self.timeout_sec is None else time.monotonic() + self.timeout_sec
+        while True:
+            message = self._next_message()
+            if message is not None:
+                if self.auto_commit_enable:
+                    self.commit_offsets()
+                return message
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                return None
+            time.sleep(self.poll_sec)
+
+    def commit_offsets(self):
+        """ Commits the last consumed offset of every partition """
+        if self.consumer_group is not None and self.consumed:
+            self.topic.commit_offsets(self.consumer_group, self.consumed)
+
+    def reset_offsets(self, partition_offsets):
+        """ The next consume() of each partition returns the message after the given offset """
+        for partition, offset in partition_offsets:
+            if offset == OffsetType.EARLIEST:
+                self.positions[partition.id] = 0
+            elif offset == OffsetType.LATEST:
+                self.positions[partition.id] = partition.latest_offset()
+            else:
+                self.positions[partition.id] = offset + 1
+            if self.positions[partition.id] > 0:
+                self.consumed[partition.id] = self.positions[partition.id] - 1
+
+    def stop(self):
+        """ Nothing to release """
+
+
+class LocalClient:
+    """ Client of the topics kept under a log directory """
+
+    def __init__(self, log_dir, partitions=None, poll_ms=10):
+        """ Initializes a client """
+        self.log_dir = log_dir
+        self.num_partitions = partitions or {}
+        self.poll_ms = poll_ms
+        self.topics = LocalTopics(self)
+
+
+class LocalTopics:
+    """ client.topics[name] """
+
+    def __init__(self, client):
+        """ Initializes the topic lookup """
+        self.client = client
+        self.lock = threading.Lock()
+        self.topics = {}
+
+    def __getitem__(self, name):
+        """ Opens a topic, creating it on first use """
+        with self.lock:
+            if name not in self.topics:
+                num_partitions = self.client.num_partitions.get(name.decode('utf-8'), 1)
+                self.topics[name] = LocalTopic(self.client, name, num_partitions)
+            return self.topics[name]
@@ -0,0 +1,54 @@
+import os
+import time
+
+from flask import g, request, Response
+from prometheus_client import Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+from connexion.apis.flask_utils import flaskify_endpoint
+
+
+REQUEST_LATENCY = Histogram("request_latency_seconds", "Time spent handling a request, per operationId", ["operation_id"])
+
+
+def operation_ids(api):
+    """ Maps the Flask endpoint name of every operation in the spec back to its operationId """
+    endpoints = {}
+    for path_item in api.specification["paths"].values():
+        for operation in path_item.values():
+            if isinstance(operation, dict) and "operationId" in operation:
+                endpoints[flaskify_endpoint(operation["operationId"])] = operation["operationId"]
+    return endpoints
+
+
+def get_metrics():
+    """ All metrics in the Prometheus text format """
+
+    # Consumer workers running as processes write their metrics to prometheus_multiproc_dir
+    if "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app, api):
+    """ Times every API request by operationId and serves GET /metrics """
+
+    endpoints = operation_ids(api)
+    flask_app = app.app
+
+    @flask_app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @flask_app.after_request
+    def observe_request(response):
+        # Without the blueprint prefix (if any)
+        operation_id = endpoints.get((request.endpoint or "").rsplit(".", 1)[-1])
+        if operation_id is not None and "request_start" in g:
+            REQUEST_LATENCY.labels(operation_id).observe(time.perf_counter() - g.request_start)
+        return response
+
+    flask_app.add_url_rule("/metrics", "metrics", get_metrics)
@@ -0,0 +1,390 @@
+"""
+End-to-end benchmark of the receiver -> Kafka -> storage -> processing pipeline
+
+Usage: python3 run_bench.py [--rate 200] [--duration 10] [--clients 8] [--db-url URL] [--output results.json]
+                            [--baseline previous.json] [--tolerance 0.25]
+
+The receiver, storage and processing services are loaded into this process and served on local ports. They use
+the local broker backend (broker.py, topics as log files in a temporary directory) instead of Kafka, and storage
+uses a temporary SQLite file (or the database given with --db-url) instead of MySQL. Nothing outside this
+machine is needed.
+
+The load generator POSTs hotel room and hotel activity bookings at a fixed rate. Every payload is stamped with
+a unique customer_id, which is followed through the pipeline to measure:
+
+- receiver latency: POST round trip
+- Kafka -> DB lag: from the message being appended to the events topic to its batch being committed by storage
+- POST -> /stats: from the POST to the first /stats response whose counts include the event
+
+With --baseline, the run fails (exit code 1) when throughput drops or a p99 grows by more than --tolerance
+compared to a previous --output file, so it can run per commit to catch regressions.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+
+import requests
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from services import load_service, Server
+
+
+def parse_args():
+    """ Command line options """
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark")
+    parser.add_argument("--rate", type=float, default=200, help="POST requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument("--activity-ratio", type=float, default=0.5, help="share of hotel activity bookings")
+    parser.add_argument("--partitions", type=int, default=4, help="partitions of the events topic")
+    parser.add_argument("--poll-ms", type=int, default=10, help="how often idle consumers check the local broker")
+    parser.add_argument("--storage-workers", type=int, default=1, help="storage consumer workers")
+    parser.add_argument("--stats-mode", choices=["poll", "stream"], default="poll", help="processing stats mode")
+    parser.add_argument("--stats-period", type=float, default=1, help="processing poll period in seconds")
+    parser.add_argument("--db-url", help="storage database (default: a temporary SQLite file)")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="seconds to wait for the pipeline to catch up")
+    parser.add_argument("--stats-timeout", type=float, default=10, help="seconds to wait for /stats to count every event")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results JSON of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression against the baseline")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the services")
+    return parser.parse_args()
+
+
+class Timeline:
+    """ Per-event timestamps, keyed by the customer_id stamped on the payload """
+
+    def __init__(self):
+        """ Initializes an empty timeline """
+        self.lock = threading.Lock()
+        self.events = {}
+
+    def record(self, stamp, stage, timestamp):
+        """ Records when an event reached a stage """
+        with self.lock:
+            self.events.setdefault(stamp, {})[stage] = timestamp
+
+    def with_stages(self, *stages):
+        """ The events that reached all the given stages """
+        with self.lock:
+            return [event for event in self.events.values() if all(stage in event for stage in stages)]
+
+
+TIMELINE = Timeline()
+
+
+def stamp_of(payload):
+    """ The benchmark stamp of an event payload """
+    return payload["customer_id"]
+
+
+def make_booking(activity):
+    """ A booking payload stamped with a unique customer_id """
+    if activity:
+        return "/booking/hotel-activities", {
+            "hotel_id": "CA-%02d" % random.randint(1, 20),
+            "customer_id": str(uuid.uuid4()),
+            "activity_id": "C%d" % random.randint(1, 9),
+            "activity_name": "Rock Climbing",
+            "num_of_people": random.randint(1, 5),
+            "reservation_date": "2023-08-09",
+            "timestamp": "2023-08-08T09:12:33.001Z"
+        }
+    return "/booking/hotel-rooms", {
+        "hotel_id": "CA-%02d" % random.randint(1, 20),
+        "customer_id": str(uuid.uuid4()),
+        "room_id": "A%03d" % random.randint(100, 999),
+        "room_type": "Single Bed",
+        "num_of_people": random.randint(1, 4),
+        "check_in_date": "2023-08-08",
+        "check_out_date": "2023-08-13",
+        "timestamp": "2023-07-29T09:12:33.001Z"
+    }
+
+
+def record_appends(broker, event_codec, events_config):
+    """ Records when each event was appended to the events topic, from the timestamps in the topic's log """
+    topic = broker.get_client(events_config).topics[b"events"]
+    consumer = topic.get_simple_consumer(auto_offset_reset=broker.OffsetType.EARLIEST, consumer_timeout_ms=0)
+    while True:
+        message = consumer.consume()
+        if message is None:
+            return
+        TIMELINE.record(stamp_of(event_codec.decode_message(message.value)["payload"]), "appended", message.timestamp / 1000.0)
+
+
+def timed_batch_writer(batch_writer_class):
+    """ Storage BatchWriter that records when each event's batch was committed """
+
+    class TimedBatchWriter(batch_writer_class):
+        """ BatchWriter with commit timestamps """
+
+        def flush(self):
+            """ Flushes the batch and records the commit time of its events """
+            stamps = [stamp_of(msg["payload"]) for msg in self.messages]
+            num_rows = batch_writer_class.flush(self)
+            stored = time.time()
+            for stamp in stamps:
+                TIMELINE.record(stamp, "stored", stored)
+            return num_rows
+
+    return TimedBatchWriter
+
+
+def events_config(args, work_dir):
+    """ Broker settings shared by all the services """
+    return {"backend": "local", "log_dir": os.path.join(work_dir, "broker"), "partitions": {"events": args.partitions},
+            "poll_ms": args.poll_ms, "max_retries": 1, "sleep_time": 0}
+
+
+def start_pipeline(args, work_dir):
+    """ Loads and starts storage, processing and the receiver. Returns the receiver and processing URLs """
+
+    events = events_config(args, work_dir)
+    os.makedirs(events["log_dir"])
+
+    # Storage: consumer workers writing to SQLite (or --db-url) instead of the MySQL datastore
+    storage = load_service("storage", work_dir, {"events": events,
+                                                 "consumers": {"mode": "thread", "workers": args.storage_workers}},
+                           args.log_level, modules=["migrations"])
+
+    db_url = args.db_url or "sqlite:///%s" % os.path.join(work_dir, "storage.sqlite")
+    if db_url.startswith("sqlite"):
+        engine = create_engine(db_url, connect_args={"timeout": 30})
+    else:
+        engine = create_engine(db_url, pool_size=5 + args.storage_workers, pool_recycle=3600, pool_pre_ping=True)
+    sys.modules["storage.migrations"].migrate(engine)
+    storage.DB_ENGINE = engine
+    storage.DB_SESSION = sessionmaker(bind=engine)
+    storage.Base.metadata.bind = engine
+    storage.BatchWriter = timed_batch_writer(storage.BatchWriter)
+    storage.start_workers()
+    storage_server = Server(storage.app.app)
+
+    # Processing: stats database in the work directory, summaries from the local storage service
+    processing = load_service("processing", work_dir, {"events": events,
+                                                       "datastore": {"filename": os.path.join(work_dir, "stats.sqlite")},
+                                                       "eventstore": {"url": storage_server.url},
+                                                       "scheduler": {"period_sec": args.stats_period},
+                                                       "stats": {"mode": args.stats_mode}},
+                              args.log_level)
+    if args.stats_mode == "stream":
+        stream = threading.Thread(target=processing.process_events)
+        stream.setDaemon(True)
+        stream.start()
+    else:
+        processing.init_scheduler()
+    processing_server = Server(processing.app.app)
+
+    receiver = load_service("receiver", work_dir, {"events": events}, args.log_level, modules=["broker", "event_codec"])
+    receiver_server = Server(receiver.app.app)
+
+    return receiver_server.url, processing_server.url
+
+
+def poll_stats(processing_url, polls, stop):
+    """ Records (time, total events counted) every time the /stats counts change """
+    session = requests.Session()
+    etag = None
+    while not stop.is_set():
+        headers = {"If-None-Match": etag} if etag else {}
+        try:
+            response = session.get(processing_url + "/stats", headers=headers, timeout=5)
+        except requests.RequestException:
+            response = None
+        if response is not None and response.status_code == 200:
+            etag = response.headers.get("ETag")
+            stats = response.json()
+            polls.append((time.time(), stats["num_hotel_room_reservations"] + stats["num_hotel_activity_reservations"]))
+        time.sleep(0.05)
+
+
+def send_bookings(receiver_url, jobs, results):
+    """ Client thread: sends each booking at its scheduled time """
+    session = requests.Session()
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        scheduled, path, payload = job
+        delay = scheduled - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        sent = time.time()
+        try:
+            status = session.post(receiver_url + path, json=payload, timeout=10).status_code
+        except requests.RequestException:
+            status = None
+        done = time.time()
+        if status == 201:
+            TIMELINE.record(stamp_of(payload), "sent", sent)
+        results.append((status, done - sent))
+
+
+def generate_load(args, receiver_url):
+    """ POSTs bookings at args.rate for args.duration seconds. Returns (status, latency) per request """
+    jobs = queue.Queue()
+    results = []
+    clients = [threading.Thread(target=send_bookings, args=(receiver_url, jobs, results)) for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    start = time.time()
+    num_requests = int(args.rate * args.duration)
+    for i in range(num_requests):
+        jobs.put((start + i / args.rate,) + make_booking(random.random() < args.activity_ratio))
+    for _ in clients:
+        jobs.put(None)
+    for client in clients:
+        client.join()
+
+    return results, time.time() - start
+
+
+def wait_for(condition, timeout):
+    """ Waits until condition() is true. Returns False on timeout """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return condition()
+
+
+def percentiles(values):
+    """ p50/p90/p99/max in milliseconds """
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(p * len(values)))] * 1000.0
+
+    return {"p50": rank(0.50), "p90": rank(0.90), "p99": rank(0.99), "max": values[-1] * 1000.0}
+
+
+def stats_latencies(polls):
+    """ POST -> /stats time of each event, counting the events in the order storage committed them """
+    events = sorted(TIMELINE.with_stages("sent", "stored"), key=lambda event: event["stored"])
+    latencies = []
+    poll_index = 0
+    for count, event in enumerate(events, 1):
+        while poll_index < len(polls) and polls[poll_index][1] < count:
+            poll_index += 1
+        if poll_index == len(polls):
+            break
+        latencies.append(max(0.0, polls[poll_index][0] - event["sent"]))
+    return latencies
+
+
+def summarize(args, results, elapsed, polls):
+    """ The benchmark results """
+    accepted = [latency for status, latency in results if status == 201]
+    stored = TIMELINE.with_stages("appended", "stored")
+    stats_latency = stats_latencies(polls)
+
+    return {
+        "date": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"rate": args.rate, "duration": args.duration, "clients": args.clients,
+                   "partitions": args.partitions, "storage_workers": args.storage_workers,
+                   "stats_mode": args.stats_mode, "database": "sqlite" if not args.db_url else args.db_url.split(":")[0]},
+        "requests": len(results),
+        "accepted": len(accepted),
+        "rejected": sum(1 for status, _ in results if status == 503),
+        "errors": sum(1 for status, _ in results if status not in (201, 503)),
+        "throughput": len(accepted) / elapsed,
+        "stored": len(stored),
+        "in_stats": len(stats_latency),
+        "receiver_latency_ms": percentiles(accepted),
+        "kafka_to_db_lag_ms": percentiles([event["stored"] - event["appended"] for event in stored]),
+        "post_to_stats_ms": percentiles(stats_latency)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Regressions against a baseline run, as messages """
+    regressions = []
+    if results["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append("throughput %.1f/s < baseline %.1f/s" % (results["throughput"], baseline["throughput"]))
+    for metric in ["receiver_latency_ms", "kafka_to_db_lag_ms", "post_to_stats_ms"]:
+        current = results[metric].get("p99")
+        previous = baseline.get(metric, {}).get("p99")
+        if current is not None and previous and current > previous * (1 + tolerance):
+            regressions.append("%s p99 %.1f ms > baseline %.1f ms" % (metric, current, previous))
+    return regressions
+
+
+def print_results(results):
+    """ Human readable results """
+    print("Requests: %(requests)d (accepted %(accepted)d, rejected %(rejected)d, errors %(errors)d), "
+          "%(throughput).1f accepted/s" % results)
+    print("Stored: %(stored)d of %(accepted)d  In /stats: %(in_stats)d of %(accepted)d" % results)
+    print("%-22s %10s %10s %10s %10s" % ("", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for metric in ["receiver_latency_ms", "kafka_to_db_lag_ms", "post_to_stats_ms"]:
+        values = results[metric]
+        if values:
+            print("%-22s %10.1f %10.1f %10.1f %10.1f" % (metric, values["p50"], values["p90"], values["p99"], values["max"]))
+        else:
+            print("%-22s %10s" % (metric, "n/a"))
+
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+
+    receiver_url, processing_url = start_pipeline(args, work_dir)
+
+    polls = []
+    stop = threading.Event()
+    poller = threading.Thread(target=poll_stats, args=(processing_url, polls, stop))
+    poller.setDaemon(True)
+    poller.start()
+
+    # In poll mode the summary windows start at the first Stats row, which processing creates on its first scheduled
+    # update. Events sent before it would never be counted in /stats, so the load only starts once it exists.
+    if args.stats_mode == "poll" and not wait_for(lambda: polls, args.stats_timeout):
+        print("Processing did not serve /stats within %.0f s" % args.stats_timeout)
+        sys.stdout.flush()
+        os._exit(1)
+
+    results, elapsed = generate_load(args, receiver_url)
+
+    # Let storage and processing catch up with everything the receiver accepted
+    num_accepted = sum(1 for status, _ in results if status == 201)
+    wait_for(lambda: len(TIMELINE.with_stages("stored")) >= num_accepted, args.drain_timeout)
+    wait_for(lambda: polls and polls[-1][1] >= num_accepted, args.stats_timeout)
+    stop.set()
+    record_appends(sys.modules["receiver.broker"], sys.modules["receiver.event_codec"], events_config(args, work_dir))
+
+    results = summarize(args, results, elapsed, polls)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if regressions:
+            exit_code = 1
+
+    # The service threads (consumers, scheduler, servers) never return on their own
+    sys.stdout.flush()
+    os._exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
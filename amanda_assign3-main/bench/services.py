@@ -0,0 +1,128 @@
+"""
+Loads the receiver, storage and processing services into this process and serves them on local ports
+
+Every service is a flat directory with its own app.py, base.py, ... so each one is imported from its own
+directory with the previously loaded service's modules removed from sys.modules first. The configuration is
+the service's own app_conf.yml with the Kafka, datastore and logging settings pointed at local stand-ins.
+"""
+import os
+import sys
+import copy
+import importlib
+import logging
+import threading
+
+import yaml
+from werkzeug.serving import make_server
+from prometheus_client import REGISTRY
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ["receiver", "storage", "processing"]
+
+
+def service_modules():
+    """ Names of all the flat modules of the loaded services """
+    names = set()
+    for service in SERVICES:
+        for filename in os.listdir(os.path.join(ROOT_DIR, service)):
+            if filename.endswith(".py"):
+                names.add(filename[:-3])
+    return names
+
+
+def load_config(service, overrides):
+    """ The service's app_conf.yml with the override sections merged in """
+    with open(os.path.join(ROOT_DIR, service, "app_conf.yml"), 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    # A None value removes the setting
+    for section, values in overrides.items():
+        if isinstance(values, dict):
+            settings = app_config.setdefault(section, {})
+            for key, value in values.items():
+                if value is None:
+                    settings.pop(key, None)
+                else:
+                    settings[key] = value
+        elif values is None:
+            app_config.pop(section, None)
+        else:
+            app_config[section] = values
+
+    return app_config
+
+
+def log_config(level):
+    """ Console only logging, so the services do not need /logs """
+    with open(os.path.join(ROOT_DIR, "receiver", "log_conf.yml"), 'r') as f:
+        config = yaml.safe_load(f.read())
+
+    config["handlers"] = {"console": copy.deepcopy(config["handlers"]["console"])}
+    config["handlers"]["console"]["level"] = level
+    config["loggers"]["basicLogger"]["handlers"] = ["console"]
+    config["loggers"]["basicLogger"]["level"] = level
+    config["root"]["level"] = level
+
+    return config
+
+
+def load_service(service, work_dir, overrides, log_level="WARNING", modules=()):
+    """
+    Imports a service's app module with its configuration written to work_dir and returns it
+
+    Other modules of the service listed in modules are imported too, and stay available as sys.modules["<service>.<name>"]
+    """
+
+    config_dir = os.path.join(work_dir, service)
+    os.makedirs(config_dir, exist_ok=True)
+    with open(os.path.join(config_dir, "app_conf.yml"), 'w') as f:
+        yaml.safe_dump(load_config(service, overrides), f)
+    with open(os.path.join(config_dir, "log_conf.yml"), 'w') as f:
+        yaml.safe_dump(log_config(log_level), f)
+
+    for name in service_modules():
+        sys.modules.pop(name, None)
+
+    # Every service registers its metrics (some under the same names) in the default registry of this one process
+    for collector in list(REGISTRY._collector_to_names):
+        REGISTRY.unregister(collector)
+
+    # The services read app_conf.yml / log_conf.yml from the working directory
+    service_dir = os.path.join(ROOT_DIR, service)
+    cwd = os.getcwd()
+    sys.path.insert(0, service_dir)
+    os.chdir(config_dir)
+    try:
+        module = importlib.import_module("app")
+        for name in modules:
+            importlib.import_module(name)
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(service_dir)
+
+    # Keep the service's modules loaded under their own names (e.g. storage.app) so the next service can load
+    for name in service_modules():
+        if name in sys.modules:
+            sys.modules["%s.%s" % (service, name)] = sys.modules.pop(name)
+
+    return module
+
+
+class Server:
+    """ Serves a Flask app on a local port from a background thread """
+
+    def __init__(self, flask_app, port=0):
+        """ Starts serving """
+        # No access log line per request
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        self.server = make_server("127.0.0.1", port, flask_app, threaded=True)
+        self.port = self.server.server_port
+        self.url = "http://127.0.0.1:%d" % self.port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stops serving """
+        self.server.shutdown()
@@ -1,5 +1,6 @@
-import React, { useEffect, useState, useCallback } from 'react';
+import React, { useState, useCallback } from 'react';
 import '../App.css';
+import useSnapshotStream from '../useSnapshotStream';
 
 export default function AppStats() {
     const [isLoaded, setIsLoaded] = useState(false);
@@ -22,10 +23,14 @@ export default function AppStats() {
             );
     }, []);
 
-    useEffect(() => {
-        const interval = setInterval(() => getStats(), 2000); // Update every 2 seconds
-        return () => clearInterval(interval);
-    }, [getStats]);
+    const onSnapshot = useCallback((result) => {
+        console.log("Received Stats");
+        setStats(result);
+        setIsLoaded(true);
+    }, []);
+
+    // Pushed by processing whenever the stats are updated, polled every 2 seconds if the stream is unavailable
+    useSnapshotStream(`http://acit3855-lab6-kafka.westus3.cloudapp.azure.com:8100/stats/stream`, onSnapshot, getStats, 2000);
 
     if (error) {
         return (<div className={"error"}>Error found when fetching from API</div>);
@@ -1,5 +1,6 @@
-import React, { useEffect, useState, useCallback } from 'react';
+import React, { useState, useCallback } from 'react';
 import '../App.css';
+import useSnapshotStream from '../useSnapshotStream';
 
 export default function EndpointAudit(props) {
     const [isLoaded, setIsLoaded] = useState(false);
@@ -25,10 +26,16 @@ export default function EndpointAudit(props) {
             );
     }, [props.endpoint, rand_val]);
 
-    useEffect(() => {
-        const interval = setInterval(() => getAudit(), 4000); // Update every 4 seconds
-        return () => clearInterval(interval);
-    }, [getAudit]);
+    // The stream picks the random event on the server and sends its index along
+    const onSnapshot = useCallback((result) => {
+        console.log("Received Audit Results for " + props.endpoint);
+        setLog(result.event);
+        setIsLoaded(true);
+        setIndex(result.index);
+    }, [props.endpoint]);
+
+    // Pushed by audit_log whenever new events are indexed, polled every 4 seconds if the stream is unavailable
+    useSnapshotStream(`http://acit3855-lab6-kafka.westus3.cloudapp.azure.com:8110/${props.endpoint}/stream`, onSnapshot, getAudit, 4000);
 
     if (error) {
         return (<div className={"error"}>Error found when fetching from API</div>);
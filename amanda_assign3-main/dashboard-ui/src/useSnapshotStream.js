@@ -0,0 +1,44 @@
+import { useEffect, useRef } from 'react';
+
+// Subscribes to the Server-Sent Events stream of a service, which pushes a snapshot only when it changes.
+// Falls back to calling poll() every pollMs when the browser has no EventSource or the stream cannot be opened.
+export default function useSnapshotStream(streamUrl, onSnapshot, poll, pollMs) {
+    // The latest callbacks, so a component re-rendering with new ones does not reopen the stream
+    const callbacks = useRef({ onSnapshot, poll });
+    callbacks.current = { onSnapshot, poll };
+
+    useEffect(() => {
+        let source = null;
+        let interval = null;
+
+        const startPolling = () => {
+            if (interval === null) {
+                callbacks.current.poll();
+                interval = setInterval(() => callbacks.current.poll(), pollMs);
+            }
+        };
+
+        if (typeof window.EventSource === 'undefined') {
+            startPolling();
+        } else {
+            source = new EventSource(streamUrl);
+            source.addEventListener('snapshot', (event) => callbacks.current.onSnapshot(JSON.parse(event.data)));
+            source.onerror = () => {
+                // A dropped connection is retried by the EventSource itself, CLOSED means it gave up
+                if (source.readyState === EventSource.CLOSED) {
+                    console.log("Stream unavailable, polling " + streamUrl);
+                    startPolling();
+                }
+            };
+        }
+
+        return () => {
+            if (source !== null) {
+                source.close();
+            }
+            if (interval !== null) {
+                clearInterval(interval);
+            }
+        };
+    }, [streamUrl, pollMs]);
+}
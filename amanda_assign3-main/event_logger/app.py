@@ -1,24 +1,36 @@
 import connexion 
 from connexion import FlaskApp
+from connexion import NoContent
+from flask import Response
 from flask_cors import CORS, cross_origin
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import func
+from sqlalchemy import event
 
 from base import Base
 from event_stats import EventStats
+import event_counter
+from response_cache import ResponseCache
+from snapshot_stream import SnapshotStream
+from response_validator import sampled_response_validator
+from broker import connect, OffsetType
+from metrics import init_metrics
+from log_setup import setup_logging, EventSampler
+from prometheus_client import Histogram
 
 import os 
+import sys
 import yaml
 import json
 import time 
 import datetime
-import logging
-import logging.config
 from threading import Thread
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
+
+# connexion imports the module of the operationIds (app) by name. Run as python3 app.py, this module is __main__,
+# so without this alias it would be imported and run a second time (connecting and registering its metrics twice)
+if __name__ == "__main__":
+    sys.modules["app"] = sys.modules[__name__]
 
 
 # with open('app_conf.yml', 'r') as f: 
@@ -47,101 +59,155 @@ with open(app_conf_file, 'r') as f:
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f.read())
 
-logging.config.dictConfig(log_config)
-logger = logging.getLogger('basicLogger')
-logger.info("App Conf File: %s" % app_conf_file)
-logger.info("Log Conf File: %s" % log_conf_file)
+# Handlers run on a background thread (log_setup.py), so logging calls do not wait for the disk
+logger = setup_logging(log_config)
+logger.info("App Conf File: %s", app_conf_file)
+logger.info("Log Conf File: %s", log_conf_file)
 
 
 db_file_path = app_config["datastore"]["filename"]
 
+# Fraction of consumed messages whose per-message lines are logged
+LOG_EVENT = EventSampler(app_config.get("logging", {}).get("event_sample_rate", 1.0))
+
+CONSUME_TO_COMMIT = Histogram("consume_to_commit_seconds", "Time from consuming an event log message until its batch is stored and its offset committed")
+BATCH_SIZE = Histogram("batch_size", "Event log messages stored per batch", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
 # Connect to the database (db name: event_stats.sqlite)
 DB_ENGINE = create_engine("sqlite:///%s" % app_config["datastore"]["filename"])
 
-if not os.path.exists(db_file_path):
-    Base.metadata.create_all(DB_ENGINE)
+@event.listens_for(DB_ENGINE, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ WAL lets get_event_stats read while the consumer writes. synchronous=NORMAL only fsyncs at WAL checkpoints """
+    sqlite_config = app_config.get("sqlite", {})
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=%s" % sqlite_config.get("journal_mode", "WAL"))
+    cursor.execute("PRAGMA synchronous=%s" % sqlite_config.get("synchronous", "NORMAL"))
+    cursor.close()
+
+# create_all only creates the tables that are missing, so existing databases pick up the counter table too
+Base.metadata.create_all(DB_ENGINE)
 
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
+# Databases created before the counters existed get them computed once from the stored messages
+session = DB_SESSION()
+if event_counter.needs_rebuild(session):
+    logger.info("Rebuilding event counts from the event_stats table")
+    event_counter.rebuild(session)
+    session.commit()
+session.close()
+
+EVENT_STATS_CACHE = ResponseCache(app_config.get("cache", {}).get("max_age_sec", 5))
+
+# Pushes the cached /event_stats response to the subscribers of /event_stats/stream after every stored batch
+EVENT_STATS_STREAM = SnapshotStream(lambda: EVENT_STATS_CACHE.get(read_event_stats),
+                                    app_config.get("push", {}).get("heartbeat_sec", 15))
+
 
 
 def process_messages():
     """ 
     Process service event messages 
     
-    - Connect to Kafka 
+    - Connect to the broker 
     - Set up a consumer  
     - Consume event log messages (receiver, storage, and processing services) from the event_log topic and save them to 1) log file 2) SQLite database 
     """
 
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-
-    current_retry = 0
-    max_retries = app_config["events"]["max_retries"]
-
-    while current_retry < max_retries:
-        try:
-            logger.info(f"Trying to connect to Kafka. Current retry count: {current_retry}")
-            client = KafkaClient(hosts=hostname) 
-            topic = client.topics[str.encode(app_config["events"]["topic"])]
-            break 
-        except:
-            logger.error("Connection failed.")
-            time.sleep(app_config["events"]["sleep_time"])
-            current_retry += 1
+    topic = connect(app_config["events"], logger, lambda client: client.topics[str.encode(app_config["events"]["topic"])])
 
     # It should be setup as a consumer for the event_log topic. Similar to the Storage service and the events topic, it should consume new messages and keep track of its offset.
     # Create a consume on a consumer group, that only reads new messages (uncommitted messages) when the service re-starts 
     # (i.e., it doesn't read all the old messages from the history in the message queue).
     
+    # The consumer times out after the linger time so a partially filled batch still gets written
+    batch_config = app_config.get("batch", {})
+    max_size = batch_config.get("max_size", 100)
+    linger_ms = batch_config.get("linger_ms", 500)
+
     consumer = topic.get_simple_consumer(consumer_group=b'event_log_group',
                                          reset_offset_on_start=False,
-                                         auto_offset_reset=OffsetType.LATEST)
+                                         auto_offset_reset=OffsetType.LATEST,
+                                         consumer_timeout_ms=linger_ms)
     
     # When it consumes one of the event log messages from the topic, it should write it to 1) it log file and 2) a database.
 
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
+    batch = []
+    batch_started = None
+    consumed_at = []
 
-        msg_info = msg["message_info"]
-        msg_code = msg["message_code"]
+    while True:
+        msg = consumer.consume()
 
-        session = DB_SESSION()
+        if msg is not None:
+            msg_str = msg.value.decode('utf-8')
+            msg = json.loads(msg_str)
 
-        stat = EventStats(
-            message_info=msg_info,
-            message_code=msg_code,
-            last_updated=datetime.datetime.now() 
-        )
+            row = {
+                "message_info": msg["message_info"],
+                "message_code": msg["message_code"],
+                "last_updated": datetime.datetime.now()
+            }
 
-        # 1) Log File 
-        logger.debug("Stored new event log message from the %s topic.\nmessage_info=%s, message_code=%s, last_updated=%s" % (app_config['events']['topic'], stat.message_info, stat.message_code, stat.last_updated))
-        
-        # 2) SQLite DB 
-        # Unique ID of the record will auto-increment
-        session.add(stat)
-        session.commit() 
-        session.close() 
+            # 1) Log File 
+            if LOG_EVENT():
+                logger.info("Message: %s", msg_str)
+                logger.debug("Stored new event log message from the %s topic.\nmessage_info=%s, message_code=%s, last_updated=%s", app_config['events']['topic'], row["message_info"], row["message_code"], row["last_updated"])
 
-        # Commit the new message as being read
-        consumer.commit_offsets()
+            if not batch:
+                batch_started = time.monotonic()
+            batch.append(row)
+            consumed_at.append(time.perf_counter())
 
+        if batch and (len(batch) >= max_size or time.monotonic() - batch_started >= linger_ms / 1000.0):
+            # 2) SQLite DB 
+            write_batch(batch)
+            EVENT_STATS_CACHE.invalidate()
+            EVENT_STATS_STREAM.refresh()
 
+            # Commit the batch of messages as being read
+            consumer.commit_offsets()
 
-def get_event_stats():
-    """ Receive event statistics from the EventStats table within the event_stats.sqlite database """
+            committed = time.perf_counter()
+            for consumed in consumed_at:
+                CONSUME_TO_COMMIT.observe(committed - consumed)
+            BATCH_SIZE.observe(len(batch))
+            batch = []
+            consumed_at = []
 
-    # Log an INFO message indicating request has started
-    logger.info("Request Started")
+
+def write_batch(rows):
+    """ Stores a batch of event log messages and their counters in one SQLite transaction """
+
+    counts = {}
+    for row in rows:
+        counts[row["message_code"]] = counts.get(row["message_code"], 0) + 1
+
+    session = DB_SESSION()
+
+    # One executemany for all rows. Unique IDs of the records will auto-increment.
+    # The counters are incremented in the same transaction so they always match the table.
+    session.execute(EventStats.__table__.insert(), rows)
+    for message_code, count in counts.items():
+        event_counter.increment(session, message_code, count)
+
+    session.commit()
+    session.close()
+
+
+
+def read_event_stats():
+    """ Counts the stored event log messages per message code """
 
     # Read in the current statistics from the SQLite database (i.e., the row with the most recent last_update datetime stamp.
     session = DB_SESSION() 
 
-    # Retrieve data from the EventStats table, select the message_code column, count number of messages for each message code, and group by the message_code column 
-    stats_counts = session.query(EventStats.message_code, func.count(EventStats.message_code)).group_by(EventStats.message_code).all()
+    # Retrieve the per message code counters (one row per code, no matter how many messages are stored)
+    stats_counts = event_counter.read_counts(session)
+
+    session.close() 
 
     # If no stats exist, log an ERROR message and return 404 and the message “Statistics do not exist” OR return empty/default statistics
     if not stats_counts:
@@ -156,21 +222,53 @@ def get_event_stats():
     # Update the counts based on the actual statistics obtained from the SQLite database
     statistics.update({code: count for code, count in stats_counts})
 
+    return statistics, 200
+
+
+def get_event_stats():
+    """ Receive event statistics from the EventStats table within the event_stats.sqlite database """
+
+    # Log an INFO message indicating request has started
+    logger.info("Request Started")
+
+    # The database is only read when new messages were stored since the last request (or the cached copy is too old)
+    statistics, status, etag = EVENT_STATS_CACHE.get(read_event_stats)
+
+    # The client already has these statistics
+    if etag is not None and connexion.request.headers.get("If-None-Match") == etag:
+        logger.info("Request Completed! Statistics not modified")
+        return NoContent, 304, {"ETag": etag}
+
     # Log a DEBUG message with the contents of the Python Dictionary
     logger.debug(statistics)
 
     # Log an INFO message indicating request has completed
     logger.info("Request Completed!")
 
-    session.close() 
+    # Errors (404 before the first statistics exist) have no ETag to revalidate against
+    if etag is None:
+        return statistics, status
 
     # Return the Python dictionary as the context and 200 as the response code
-    return statistics, 200 
+    return statistics, status, {"ETag": etag}
+
+
+def get_event_stats_stream():
+    """ Streams the event statistics as Server-Sent Events, pushing a new snapshot every time messages are stored """
+
+    logger.info("Stream Started")
 
+    # A reconnecting dashboard only gets the statistics again when they changed in the meantime
+    return Response(EVENT_STATS_STREAM.events(connexion.request.headers.get("Last-Event-ID")),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 app = connexion.FlaskApp(__name__, specification_dir="")
-app.add_api("openapi.yaml", strict_validation=True, validate_responses=True) 
+# The validator passes the event streams through, validating them would wait for the end of the stream
+api = app.add_api("openapi.yaml", strict_validation=True, validate_responses=True,
+                  validator_map={"response": sampled_response_validator(app_config.get("response_validation", {}))}) 
+init_metrics(app, api)
 
 CORS(app.app)
 app.app.config["CORS_HEADERS"] = "Content-Type"
@@ -0,0 +1,16 @@
+from sqlalchemy import Column, Integer, String
+from base import Base
+
+class EventCount(Base):
+    """ Number of event log messages stored for a message code, kept in step with the event_stats table """
+
+    __tablename__ = "event_count"
+
+    message_code = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+    def __init__(self, message_code, count):
+        """ Initializes the EventCount object """
+
+        self.message_code = message_code
+        self.count = count
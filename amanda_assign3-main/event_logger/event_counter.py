@@ -0,0 +1,29 @@
+from sqlalchemy import func
+
+from event_stats import EventStats
+from event_count import EventCount
+
+
+def increment(session, message_code, amount=1):
+    """ Adds to the counter of a message code in the session's transaction """
+    updated = session.query(EventCount).filter(EventCount.message_code == message_code).update(
+        {EventCount.count: EventCount.count + amount}, synchronize_session=False)
+    if not updated:
+        session.add(EventCount(message_code, amount))
+
+
+def read_counts(session):
+    """ Returns (message_code, count) pairs for every counted message code """
+    return session.query(EventCount.message_code, EventCount.count).all()
+
+
+def rebuild(session):
+    """ Recomputes every counter from the event_stats table """
+    session.query(EventCount).delete(synchronize_session=False)
+    for message_code, count in session.query(EventStats.message_code, func.count(EventStats.id)).group_by(EventStats.message_code):
+        session.add(EventCount(message_code, count))
+
+
+def needs_rebuild(session):
+    """ True when there are stored messages but no counters (e.g. a database created before the counters existed) """
+    return session.query(EventCount).first() is None and session.query(EventStats).first() is not None
@@ -0,0 +1,30 @@
+import os
+import yaml
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from base import Base
+import event_counter
+
+if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+    app_conf_file = "/config/app_conf.yml"
+else:
+    app_conf_file = "app_conf.yml"
+
+with open(app_conf_file, 'r') as f:
+    app_config = yaml.safe_load(f.read())
+
+DB_ENGINE = create_engine("sqlite:///%s" % app_config["datastore"]["filename"])
+Base.metadata.create_all(DB_ENGINE)
+DB_SESSION = sessionmaker(bind=DB_ENGINE)
+
+# Recompute the per-code counters from the raw event_stats table in one transaction
+session = DB_SESSION()
+event_counter.rebuild(session)
+session.commit()
+
+for message_code, count in event_counter.read_counts(session):
+    print("%s: %d" % (message_code, count))
+
+session.close()
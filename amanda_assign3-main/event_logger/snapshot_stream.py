@@ -0,0 +1,64 @@
+import json
+import threading
+
+
+class SnapshotStream:
+    """
+    Pushes the latest snapshot of a resource to its subscribers as Server-Sent Events
+
+    refresh() is called after every write. It computes the snapshot once and wakes the subscribers if it changed,
+    so open dashboards cost nothing while nothing is written, no matter how many there are.
+    """
+
+    def __init__(self, snapshot, heartbeat_sec=15, retry_ms=5000):
+        """ snapshot() returns (body, status, etag) of the resource """
+        self.snapshot = snapshot
+        self.heartbeat_sec = heartbeat_sec
+        self.retry_ms = retry_ms
+        self.condition = threading.Condition()
+        self.current = None
+        self.version = 0
+
+    def refresh(self):
+        """ Computes the snapshot and pushes it to the subscribers when its etag changed """
+        body, status, etag = self.snapshot()
+
+        # Errors (e.g. no statistics yet) are not pushed, the subscribers keep the last snapshot they got
+        if status != 200:
+            return
+
+        with self.condition:
+            if self.current is None or self.current[1] != etag:
+                self.current = (body, etag)
+                self.version += 1
+                self.condition.notify_all()
+
+    def events(self, last_event_id=None):
+        """ The current snapshot, then each new one, as SSE frames (with a comment frame as heartbeat) """
+
+        # The first subscriber computes the snapshot, later ones get the one that was pushed last
+        if self.current is None:
+            self.refresh()
+
+        yield "retry: %d\n\n" % self.retry_ms
+
+        seen = 0
+        while True:
+            with self.condition:
+                if self.version == seen:
+                    self.condition.wait(self.heartbeat_sec)
+                current = self.current if self.version != seen else None
+                seen = self.version
+
+            # Writing the heartbeat is what notices a closed connection and ends the generator
+            if current is None:
+                yield ": keep-alive\n\n"
+                continue
+
+            body, etag = current
+
+            # A reconnecting EventSource sends the id of the last snapshot it received
+            if etag == last_event_id:
+                continue
+
+            yield "id: %s\nevent: snapshot\ndata: %s\n\n" % (etag, json.dumps(body))
@@ -1,26 +1,42 @@
 import os
+import sys
 import json
 import time
 import datetime
-import logging
-import logging.config
+from threading import Thread
 import requests
 
 import yaml
 
 import connexion
 from connexion import FlaskApp
+from connexion import NoContent
+from flask import Response
 from flask_cors import CORS
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from pytz import timezone
-from pykafka import KafkaClient
 from apscheduler.schedulers.background import BackgroundScheduler
+from prometheus_client import Histogram
 
 from base import Base
+from broker import connect, make_producer, OffsetType
+from event_codec import decode_message
 from stats import Stats
+from checkpoint import StatsCheckpoint
+from response_cache import ResponseCache
+from snapshot_stream import SnapshotStream
+from response_validator import sampled_response_validator
+from stats_store import StatsStore
+from metrics import init_metrics
+from log_setup import setup_logging
+
+# connexion imports the module of the operationIds (app) by name. Run as python3 app.py, this module is __main__,
+# so without this alias it would be imported and run a second time (connecting and registering its metrics twice)
+if __name__ == "__main__":
+    sys.modules["app"] = sys.modules[__name__]
 
 
 
@@ -40,8 +56,8 @@ with open(APP_CONF_FILE, 'r') as f:
 with open(LOG_CONF_FILE, 'r') as f:
     log_config = yaml.safe_load(f.read())
 
-logging.config.dictConfig(log_config)
-logger = logging.getLogger('basicLogger')
+# Handlers run on a background thread (log_setup.py), so logging calls do not wait for the disk
+logger = setup_logging(log_config)
 logger.info("App Conf File: %s", APP_CONF_FILE)
 logger.info("Log Conf File: %s", LOG_CONF_FILE)
 
@@ -49,28 +65,35 @@ db_file_path = app_config["datastore"]["filename"]
 
 DB_ENGINE = create_engine("sqlite:///%s" % app_config["datastore"]["filename"])
 
-if not os.path.exists(db_file_path):
-    Base.metadata.create_all(DB_ENGINE)
+# create_all only creates the tables that are missing, so existing databases pick up new tables too
+Base.metadata.create_all(DB_ENGINE)
 
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
-CURRENT_RETRY = 0
-max_retries = app_config["events"]["max_retries"]
+# append: a new Stats row per update. single: one current row updated in place. 
+# rollups: number of ring buffer slots kept per resolution (minute/hour/day).
+STATS_STORE = StatsStore(app_config.get("history", {}).get("mode", "append"),
+                         app_config.get("history", {}).get("rollups", {}))
+STATS_STORE.setup(DB_ENGINE, DB_SESSION)
+
+POPULATE_DURATION = Histogram("populate_stats_duration_seconds", "Time spent in one periodic statistics update")
+POPULATE_EVENTS = Histogram("populate_stats_events", "New events summarized by one periodic statistics update",
+                            buckets=(0, 1, 10, 25, 100, 1000, 10000, 100000))
+
+STATS_CACHE = ResponseCache(app_config.get("cache", {}).get("max_age_sec", 5))
+
+# Pushes the cached /stats response to the subscribers of /stats/stream after every update
+STATS_STREAM = SnapshotStream(lambda: STATS_CACHE.get(read_stats), app_config.get("push", {}).get("heartbeat_sec", 15))
 
-while CURRENT_RETRY < max_retries:
-    try:
-        logger.info(f"Trying to connect to Kafka. Current retry count: {CURRENT_RETRY}")
-        client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-        topic = client.topics[str.encode(app_config["events"]["topic"])]
-        producer = topic.get_sync_producer()
+def setup_producer(client):
+    """ Producer for the event_log topic """
+    topic = client.topics[str.encode(app_config["events"]["topic"])]
+    return client, make_producer(topic, app_config.get("producer"))
 
-        break
 
-    except:
-        logger.error("Connection failed.")
-        time.sleep(app_config["events"]["sleep_time"])
-        CURRENT_RETRY += 1
+# The client is kept for the streaming statistics consumer
+client, producer = connect(app_config["events"], logger, setup_producer) or (None, None)
 
 
 def load(only_producer):
@@ -86,19 +109,17 @@ def load(only_producer):
         only_producer.produce(ready_msg_str.encode('utf-8'))
 
 
-def get_stats():
-    """ Gets Hotel Room and Hotel Activity processsed statistics """
-
-    # Log an INFO message indicating request has started
-    logger.info("Request Started")
+def read_stats():
+    """ Reads the current statistics from the SQLite database """
 
     # Read in the current statistics from the SQLite database (i.e., the row with the most recent last_update datetime stamp.
     session = DB_SESSION()
 
-    stats = session.query(Stats).order_by(Stats.last_updated.desc()).first()
+    stats = STATS_STORE.load_current(session)
 
     # If no stats exist, log an ERROR message and return 404 and the message “Statistics do not exist” OR return empty/default statistics
     if stats is None:
+        session.close()
         logger.error("Statistics do not exist")
         return "Statistics do not exist", 404
 
@@ -114,17 +135,64 @@ def get_stats():
         "last_updated": last_updated_vancouver.strftime('%Y-%m-%d %H:%M:%S %Z%z')
     }
 
+    session.close()
+
+    return statistics, 200
+
+def get_stats():
+    """ Gets Hotel Room and Hotel Activity processsed statistics """
+
+    # Log an INFO message indicating request has started
+    logger.info("Request Started")
+
+    # The database is only read when the statistics changed since the last request (or the cached copy is too old)
+    statistics, status, etag = STATS_CACHE.get(read_stats)
+
+    # The client already has these statistics
+    if etag is not None and connexion.request.headers.get("If-None-Match") == etag:
+        logger.info("Request Completed! Statistics not modified")
+        return NoContent, 304, {"ETag": etag}
+
     # Log a DEBUG message with the contents of the Python Dictionary
     logger.debug(statistics)
 
     # Log an INFO message indicating request has completed
     logger.info("Request Completed!")
 
-    session.close()
+    # Errors (404 before the first statistics exist) have no ETag to revalidate against
+    if etag is None:
+        return statistics, status
 
     # Return the Python dictionary as the context and 200 as the response code
-    return statistics, 200
+    return statistics, status, {"ETag": etag}
+
+def get_stats_stream():
+    """ Streams the statistics as Server-Sent Events, pushing a new snapshot every time they are updated """
+
+    logger.info("Stream Started")
+
+    # A reconnecting dashboard only gets the statistics again when they changed in the meantime
+    return Response(STATS_STREAM.events(connexion.request.headers.get("Last-Event-ID")),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
+def get_stats_history(resolution):
+    """ Gets the historical statistics kept for a rollup resolution, oldest first """
+
+    logger.info("Request Started")
+
+    session = DB_SESSION()
+    history = [snapshot.to_dict() for snapshot in STATS_STORE.history(session, resolution)]
+    session.close()
+
+    for snapshot in history:
+        snapshot["bucket_start"] = snapshot["bucket_start"].strftime("%Y-%m-%dT%H:%M:%S")
+
+    logger.info("Request Completed! Returned %d %s snapshots", len(history), resolution)
+
+    return history, 200
+
+@POPULATE_DURATION.time()
 def populate_stats():
     """ Periodically update stats """
 
@@ -134,9 +202,8 @@ def populate_stats():
     # Read in the current statistics from the SQLite database (filename defined in your configuration)
     session = DB_SESSION()
 
-    # Query to get all the Stats objects from the database in descending order (from newest to oldest)
-    # Note that the first would be the most recent in this case
-    stats = session.query(Stats).order_by(Stats.last_updated.desc()).first()
+    # Get the most recent statistics from the database
+    stats = STATS_STORE.load_current(session)
 
     # - If no stats yet exist, use default values for the stats
     if stats is None:
@@ -159,88 +226,43 @@ def populate_stats():
     curren_dateime_formatted = current_datetime.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
     last_updated_formatted = last_updated.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
 
-    # Query the two GET endpoints from your Data Store Service (using requests.get) to get all new events
-    # from the last datetime you requested them (from your statistics) to the current datetime
-    hotel_rooms_url = f"{app_config['eventstore']['url']}/booking/hotel-rooms?start_timestamp={last_updated_formatted}&end_timestamp={curren_dateime_formatted}"
-    hotel_activities_url = f"{app_config['eventstore']['url']}/booking/hotel-activities?start_timestamp={last_updated_formatted}&end_timestamp={curren_dateime_formatted}"
-
-    event_1_response = requests.get(hotel_rooms_url, timeout=10)
-    event_2_response = requests.get(hotel_activities_url, timeout=10)
+    # Query the summary endpoint of the Data Store Service (using requests.get) to get the counts and maximums
+    # of all new events from the last datetime you requested them (from your statistics) to the current datetime
+    summary_url = f"{app_config['eventstore']['url']}/booking/summary?start_timestamp={last_updated_formatted}&end_timestamp={curren_dateime_formatted}"
 
-    event_1_res_json = event_1_response.json()
-    event_2_res_json = event_2_response.json()
+    summary_response = requests.get(summary_url, timeout=10)
 
     # - Log an INFO message with the number of events received
-    if event_1_response.status_code == 200 and event_2_response.status_code == 200:
-        logger.info(f"Received {len(event_1_res_json)} Hotel Room Reservation events and {len(event_2_res_json)} Hotel Activity Reservation events")
+    if summary_response.status_code == 200:
+        summary = summary_response.json()
+        logger.info("Received %d Hotel Room Reservation events and %d Hotel Activity Reservation events", summary['num_hotel_room_reservations'], summary['num_hotel_activity_reservations'])
 
     # - Log an ERROR message if you did not get a 200 response code
     else:
-        logger.error(f'''Failed to retrieve events from Hotel Room and Hotel Activity Reservations:
-
-                        Hotel Rooms Error: {event_1_response.text},
-
-                        Hotel Activities Error: {event_2_response.text}''')
+        logger.error("Failed to retrieve the Hotel Room and Hotel Activity Reservations summary: %s", summary_response.text)
         return
 
     # Based on the new events from the Data Store Service:
     # Calculate your updated statistics
-
-    max_hotel_room_ppl_sql = stats.max_hotel_room_ppl
-
-    max_hotel_activity_ppl_sql = stats.max_hotel_activity_ppl
-
-
-    if len(event_1_res_json):
-        max_hotel_room_ppl_json = max(event_1_res_json, key=lambda event1: event1["num_of_people"])["num_of_people"]
-
-        if max_hotel_room_ppl_json > max_hotel_room_ppl_sql:
-            new_max_hotel_room_ppl = max_hotel_room_ppl_json
-        else:
-            new_max_hotel_room_ppl = max_hotel_room_ppl_sql
-    else:
-        new_max_hotel_room_ppl = max_hotel_room_ppl_sql
-
-
-    if len(event_2_res_json):
-        max_hotel_activity_ppl_json = max(event_2_res_json, key=lambda event2: event2["num_of_people"])["num_of_people"]
-
-        if max_hotel_activity_ppl_json > max_hotel_activity_ppl_sql:
-            new_max_hotel_activity_ppl = max_hotel_activity_ppl_json
-        else:
-            new_max_hotel_activity_ppl = max_hotel_activity_ppl_sql
-    else:
-        new_max_hotel_activity_ppl = max_hotel_activity_ppl_sql
-
-    new_num_hotel_room_reservations = stats.num_hotel_room_reservations + len(event_1_res_json)
-    new_num_hotel_activity_reservations = stats.num_hotel_activity_reservations + len(event_2_res_json)
-
-    new_stats = Stats(
-        num_hotel_room_reservations=new_num_hotel_room_reservations,
-        max_hotel_room_ppl=new_max_hotel_room_ppl,
-        num_hotel_activity_reservations=new_num_hotel_activity_reservations,
-        max_hotel_activity_ppl=new_max_hotel_activity_ppl,
-        last_updated=current_datetime
-    )
+    new_values = {
+        "num_hotel_room_reservations": stats.num_hotel_room_reservations + summary["num_hotel_room_reservations"],
+        "max_hotel_room_ppl": max(stats.max_hotel_room_ppl, summary["max_hotel_room_ppl"]),
+        "num_hotel_activity_reservations": stats.num_hotel_activity_reservations + summary["num_hotel_activity_reservations"],
+        "max_hotel_activity_ppl": max(stats.max_hotel_activity_ppl, summary["max_hotel_activity_ppl"])
+    }
 
     # Write the updated statistics to the SQLite database file (filename defined in your configuration)
-    session.add(new_stats)
-
-    # Log a DEBUG message for each event processed that includes the trace_id
-    if len(event_1_res_json):
-        trace_ids = [event_1["trace_id"] for event_1 in event_1_res_json]
-        logger.debug(f"Processed Hotel Room Reservation Event Trace IDs: {', '.join(trace_ids)}")
-
-    if len(event_2_res_json):
-        trace_ids = [event_2["trace_id"] for event_2 in event_2_res_json]
-        logger.debug(f"Processed Hotel Activity Reservation Event Trace IDs: {', '.join(trace_ids)}")
+    new_stats = STATS_STORE.save(session, new_values, current_datetime)
 
     # Log a DEBUG message with your updated statistics values
-    logger.debug(f"Num Hotel Room Reservations: {new_stats.num_hotel_room_reservations} \n"
-                 f"Max Hotel Room People: {new_stats.max_hotel_room_ppl} \n" 
-                 f"Num Hotel Activity Reservations: {new_stats.num_hotel_activity_reservations} \n"
-                 f"Max Hotel Activity People: {new_stats.max_hotel_activity_ppl}\n"
-                 f"Last Updated: {new_stats.last_updated.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'}")
+    logger.debug("Num Hotel Room Reservations: %d \n"
+                 "Max Hotel Room People: %d \n" 
+                 "Num Hotel Activity Reservations: %d \n"
+                 "Max Hotel Activity People: %d\n"
+                 "Last Updated: %s",
+                 new_stats.num_hotel_room_reservations, new_stats.max_hotel_room_ppl,
+                 new_stats.num_hotel_activity_reservations, new_stats.max_hotel_activity_ppl,
+                 new_stats.last_updated.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z')
 
     # Log an INFO message indicating period processing has ended
     logger.info("End Periodic Processing")
@@ -248,7 +270,8 @@ def populate_stats():
     # On periodic processing if it receives more than a configurable number of messages.
     # The default is 25 for this configurable value. The code for this message is 0004.
     threshold = app_config["events"]["event_threshold"]
-    total_events_received = len(event_1_res_json) + len(event_2_res_json)
+    total_events_received = summary["num_hotel_room_reservations"] + summary["num_hotel_activity_reservations"]
+    POPULATE_EVENTS.observe(total_events_received)
 
     if total_events_received > threshold:
         msg = {
@@ -261,6 +284,130 @@ def populate_stats():
     session.commit()
     session.close()
 
+    STATS_CACHE.invalidate()
+    STATS_STREAM.refresh()
+
+
+def get_current_stats(session):
+    """ Returns the most recent statistics, or zeroed statistics if none exist yet """
+
+    stats = STATS_STORE.load_current(session)
+
+    if stats is None:
+        stats = Stats(
+            num_hotel_room_reservations = 0,
+            max_hotel_room_ppl = 0,
+            num_hotel_activity_reservations = 0,
+            max_hotel_activity_ppl = 0,
+            last_updated=datetime.datetime.now()
+        )
+
+    return stats
+
+
+def fold_event(totals, msg):
+    """ Folds one event from the events topic into the running counters and maxima """
+
+    num_of_people = msg["payload"]["num_of_people"]
+
+    if msg["type"] == "hotel_room":
+        totals["num_hotel_room_reservations"] += 1
+        totals["max_hotel_room_ppl"] = max(totals["max_hotel_room_ppl"], num_of_people)
+    elif msg["type"] == "hotel_activity":
+        totals["num_hotel_activity_reservations"] += 1
+        totals["max_hotel_activity_ppl"] = max(totals["max_hotel_activity_ppl"], num_of_people)
+
+
+def save_checkpoint(totals, offsets):
+    """ Writes the statistics and the consumed offsets in one SQLite transaction """
+
+    session = DB_SESSION()
+
+    STATS_STORE.save(session, totals, datetime.datetime.now())
+    for partition_id, offset in offsets.items():
+        session.merge(StatsCheckpoint(partition_id, offset))
+
+    session.commit()
+    session.close()
+
+    STATS_CACHE.invalidate()
+    STATS_STREAM.refresh()
+
+
+def process_events():
+    """ 
+    Streaming statistics 
+
+    - Consume the events topic with the processing consumer group
+    - Fold each event into running counters and maxima
+    - Periodically checkpoint the statistics together with the last consumed offset of each partition,
+      so a restart resumes exactly where the saved statistics left off
+    """
+
+    stream_config = app_config["stream"]
+    checkpoint_events = stream_config.get("checkpoint_events", 100)
+    checkpoint_ms = stream_config.get("checkpoint_ms", 1000)
+
+    events_topic = client.topics[str.encode(stream_config["topic"])]
+
+    # Offsets live in the stats database (not in Kafka), so the consumer never commits them itself
+    consumer = events_topic.get_simple_consumer(consumer_group=str.encode(stream_config["consumer_group"]),
+                                                auto_commit_enable=False,
+                                                reset_offset_on_start=False,
+                                                auto_offset_reset=OffsetType.EARLIEST,
+                                                consumer_timeout_ms=checkpoint_ms)
+
+    session = DB_SESSION()
+    stats = get_current_stats(session)
+    checkpoints = session.query(StatsCheckpoint).all()
+    session.close()
+
+    totals = {
+        "num_hotel_room_reservations": stats.num_hotel_room_reservations,
+        "max_hotel_room_ppl": stats.max_hotel_room_ppl,
+        "num_hotel_activity_reservations": stats.num_hotel_activity_reservations,
+        "max_hotel_activity_ppl": stats.max_hotel_activity_ppl
+    }
+
+    # Without a checkpoint the whole topic is replayed from the earliest offset, so the counts start from zero:
+    # statistics saved by poll mode already include those events and would count them twice
+    if not checkpoints:
+        totals = dict.fromkeys(totals, 0)
+
+    # Resume right after the last offset that is already included in the saved statistics
+    if checkpoints:
+        consumer.reset_offsets([(events_topic.partitions[checkpoint.partition_id], checkpoint.kafka_offset)
+                                for checkpoint in checkpoints])
+        logger.info("Resuming statistics from offsets %s", {checkpoint.partition_id: checkpoint.kafka_offset for checkpoint in checkpoints})
+
+    offsets = {}
+    pending = 0
+    last_checkpoint = time.monotonic()
+
+    while True:
+        msg = consumer.consume()
+
+        if msg is not None:
+            fold_event(totals, decode_message(msg.value))
+            offsets[msg.partition_id] = msg.offset
+            pending += 1
+
+        if pending and (pending >= checkpoint_events or time.monotonic() - last_checkpoint >= checkpoint_ms / 1000.0):
+            save_checkpoint(totals, offsets)
+            logger.debug("Checkpointed statistics %s at offsets %s", totals, offsets)
+
+            threshold = app_config["events"]["event_threshold"]
+            if pending > threshold:
+                msg = {
+                    "message_info": f"Total events received exceeded threshold ({threshold})",
+                    "message_code": "0004"
+                }
+                msg_str = json.dumps(msg)
+                producer.produce(msg_str.encode('utf-8'))
+
+            pending = 0
+            last_checkpoint = time.monotonic()
+
 
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True, timezone=timezone('America/Vancouver'))
@@ -271,13 +418,22 @@ def init_scheduler():
 
 
 app = connexion.FlaskApp(__name__, specification_dir="")
-app.add_api("openapi.yaml", strict_validation=True, validate_responses=True)
+# The validator passes the event streams through, validating them would wait for the end of the stream
+api = app.add_api("openapi.yaml", strict_validation=True, validate_responses=True,
+                  validator_map={"response": sampled_response_validator(app_config.get("response_validation", {}))})
+init_metrics(app, api)
 
 CORS(app.app)
 app.app.config["CORS_HEADERS"] = "Content-Type"
 
 
 if __name__ == "__main__":
-    init_scheduler()
+    # poll: periodically query the storage service. stream: consume the events topic directly.
+    if app_config.get("stats", {}).get("mode", "poll") == "stream":
+        t1 = Thread(target=process_events)
+        t1.setDaemon(True)
+        t1.start()
+    else:
+        init_scheduler()
     load(producer)
     app.run(port=8100)
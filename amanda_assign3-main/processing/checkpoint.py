@@ -0,0 +1,16 @@
+from sqlalchemy import Column, Integer
+from base import Base
+
+class StatsCheckpoint(Base):
+    """ Last events topic offset folded into the statistics, per partition """
+
+    __tablename__ = "stats_checkpoint"
+
+    partition_id = Column(Integer, primary_key=True, autoincrement=False)
+    kafka_offset = Column(Integer, nullable=False)
+
+    def __init__(self, partition_id, kafka_offset):
+        """ Initializes a statistics checkpoint """
+
+        self.partition_id = partition_id
+        self.kafka_offset = kafka_offset
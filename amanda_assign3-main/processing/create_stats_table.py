@@ -15,5 +15,9 @@ c.execute('''
            last_updated VARCHAR(100) NOT NULL)
           ''')
 
+c.execute('''
+          CREATE INDEX ix_stats_last_updated ON stats (last_updated)
+          ''')
+
 conn.commit()
 conn.close()
@@ -0,0 +1,37 @@
+import json
+import time
+import hashlib
+import threading
+
+
+class ResponseCache:
+    """ Keeps the last response of a GET endpoint until it is invalidated or older than max_age_sec """
+
+    def __init__(self, max_age_sec=5):
+        """ Initializes an empty cache """
+        self.max_age_sec = max_age_sec
+        self.lock = threading.Lock()
+        self.entry = None
+        self.created = 0
+
+    def get(self, compute):
+        """
+        Returns (body, status, etag), calling compute() for (body, status) only when the cache is empty or stale
+
+        Only 200 responses are cached and have an etag: an error (e.g. 404 before the first statistics exist) is
+        returned with etag None and computed again on the next request.
+        """
+        with self.lock:
+            if self.entry is None or time.monotonic() - self.created >= self.max_age_sec:
+                body, status = compute()
+                if status != 200:
+                    return body, status, None
+                etag = '"%s"' % hashlib.md5(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+                self.entry = (body, status, etag)
+                self.created = time.monotonic()
+            return self.entry
+
+    def invalidate(self):
+        """ Drops the cached response (called after every write) """
+        with self.lock:
+            self.entry = None
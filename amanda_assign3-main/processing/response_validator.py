@@ -0,0 +1,37 @@
+import random
+import functools
+
+from flask import Response
+from connexion.decorators.response import ResponseValidator
+
+
+def sampled_response_validator(sample_rates):
+    """ Builds a response validator class that validates each operation's responses at its configured sample rate """
+
+    class SampledResponseValidator(ResponseValidator):
+        """ Response validator that samples responses and passes streamed responses (NDJSON) through """
+
+        def __call__(self, function):
+            """ Wraps the operation handler """
+
+            sample_rate = sample_rates.get(self.operation.operation_id, 1.0)
+
+            @functools.wraps(function)
+            def wrapper(request):
+                response = function(request)
+
+                # Validating needs the whole body, which would defeat streaming
+                if isinstance(response, Response) and response.is_streamed:
+                    return response
+
+                if sample_rate < 1.0 and random.random() >= sample_rate:
+                    return response
+
+                connexion_response = self.operation.api.get_connexion_response(response, self.mimetype)
+                self.validate_response(connexion_response.body, connexion_response.status_code,
+                                       connexion_response.headers, request.url)
+                return response
+
+            return wrapper
+
+    return SampledResponseValidator
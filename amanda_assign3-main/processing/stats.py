@@ -12,7 +12,7 @@ class Stats(Base):
     max_hotel_room_ppl = Column(Integer, nullable=False)
     num_hotel_activity_reservations = Column(Integer, nullable=False)
     max_hotel_activity_ppl = Column(Integer, nullable=False)
-    last_updated = Column(DateTime, nullable=False)
+    last_updated = Column(DateTime, nullable=False, index=True)
 
     def __init__(self, num_hotel_room_reservations, max_hotel_room_ppl, num_hotel_activity_reservations, max_hotel_activity_ppl, last_updated):
         """ Initializes a processing statistics object """
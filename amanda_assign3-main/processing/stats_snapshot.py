@@ -0,0 +1,40 @@
+from sqlalchemy import Column, Integer, String, DateTime
+from base import Base
+
+class StatsSnapshot(Base):
+    """ One slot of a fixed-size ring buffer of historical statistics at a given resolution """
+
+    __tablename__ = "stats_snapshot"
+
+    resolution = Column(String(10), primary_key=True)
+    slot = Column(Integer, primary_key=True, autoincrement=False)
+    bucket_start = Column(DateTime, nullable=False)
+    num_hotel_room_reservations = Column(Integer, nullable=False)
+    max_hotel_room_ppl = Column(Integer, nullable=False)
+    num_hotel_activity_reservations = Column(Integer, nullable=False)
+    max_hotel_activity_ppl = Column(Integer, nullable=False)
+
+    def __init__(self, resolution, slot, bucket_start, num_hotel_room_reservations, max_hotel_room_ppl, num_hotel_activity_reservations, max_hotel_activity_ppl):
+        """ Initializes a statistics snapshot """
+
+        self.resolution = resolution
+        self.slot = slot
+        self.bucket_start = bucket_start
+        self.num_hotel_room_reservations = num_hotel_room_reservations
+        self.max_hotel_room_ppl = max_hotel_room_ppl
+        self.num_hotel_activity_reservations = num_hotel_activity_reservations
+        self.max_hotel_activity_ppl = max_hotel_activity_ppl
+
+    def to_dict(self):
+        """ Dictionary Representation of a statistics snapshot """
+
+        dict = {}
+
+        dict["resolution"] = self.resolution
+        dict["bucket_start"] = self.bucket_start
+        dict["num_hotel_room_reservations"] = self.num_hotel_room_reservations
+        dict["max_hotel_room_ppl"] = self.max_hotel_room_ppl
+        dict["num_hotel_activity_reservations"] = self.num_hotel_activity_reservations
+        dict["max_hotel_activity_ppl"] = self.max_hotel_activity_ppl
+
+        return dict
@@ -0,0 +1,83 @@
+import datetime
+
+from sqlalchemy import inspect
+
+from stats import Stats
+from stats_snapshot import StatsSnapshot
+
+
+STATS_FIELDS = ["num_hotel_room_reservations", "max_hotel_room_ppl",
+                "num_hotel_activity_reservations", "max_hotel_activity_ppl"]
+
+# Length of one ring buffer bucket per rollup resolution
+RESOLUTIONS = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class StatsStore:
+    """
+    Reads and writes the processing statistics
+
+    - append: a new Stats row for every update (the original behaviour)
+    - single: one current Stats row that is updated in place
+
+    In both modes a fixed number of snapshots per rollup resolution (e.g. the last 1440 minutes) is kept in a ring buffer,
+    so the database stops growing once every slot has been used.
+    """
+
+    def __init__(self, mode="append", rollups=None):
+        """ Initializes the statistics store """
+        self.mode = mode
+        self.rollups = rollups or {}
+
+    def setup(self, engine, db_session):
+        """ Adds indexes missing from older databases and, in single mode, removes all but the current row """
+        existing = [index["name"] for index in inspect(engine).get_indexes(Stats.__tablename__)]
+        for index in Stats.__table__.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+        if self.mode == "single":
+            session = db_session()
+            current = self.load_current(session)
+            if current is not None:
+                session.query(Stats).filter(Stats.id != current.id).delete(synchronize_session=False)
+                session.commit()
+            session.close()
+
+    def load_current(self, session):
+        """ Returns the most recent statistics, or None if there are none yet """
+        return session.query(Stats).order_by(Stats.last_updated.desc()).first()
+
+    def save(self, session, values, last_updated):
+        """ Adds the new statistics to the session (the caller commits) """
+
+        stats = None
+        if self.mode == "single":
+            stats = self.load_current(session)
+
+        if stats is None:
+            stats = Stats(last_updated=last_updated, **values)
+            session.add(stats)
+        else:
+            for field in STATS_FIELDS:
+                setattr(stats, field, values[field])
+            stats.last_updated = last_updated
+
+        # The statistics are running totals, so the last value written in a bucket is that bucket's rollup
+        for resolution, num_slots in self.rollups.items():
+            bucket_seconds = RESOLUTIONS[resolution]
+            bucket = int((last_updated - EPOCH).total_seconds()) // bucket_seconds
+            session.merge(StatsSnapshot(resolution, bucket % num_slots, EPOCH + datetime.timedelta(seconds=bucket * bucket_seconds),
+                                        **{field: values[field] for field in STATS_FIELDS}))
+
+        return stats
+
+    def history(self, session, resolution):
+        """ Returns the snapshots kept for a resolution, oldest first """
+        return session.query(StatsSnapshot).filter(StatsSnapshot.resolution == resolution).order_by(StatsSnapshot.bucket_start).all()
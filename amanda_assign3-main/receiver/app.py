@@ -1,15 +1,30 @@
 import os
+import sys
 import time
-import logging
-import logging.config
+import asyncio
+import atexit
 import uuid
 import datetime
 import json
 import yaml
 import connexion
 from connexion import NoContent
-from pykafka import KafkaClient
-
+from connexion.json_schema import Draft4RequestValidator
+from flask import request
+from jsonschema import ValidationError, draft4_format_checker
+from prometheus_client import Counter
+
+from broker import connect, hashing_partitioner, make_producer
+from event_producer import EventProducer, PRODUCE_LATENCY
+from event_codec import encode_message, FORMATS
+from metrics import init_metrics
+from log_setup import setup_logging, EventSampler
+
+# connexion imports the module of the operationIds (app) by name. Run as python3 app.py, this module is __main__,
+# so without this alias it would be imported and run a second time (connecting and registering its metrics twice).
+# uvicorn's worker processes run this file as __mp_main__ before importing app:asgi_app, which is the same module.
+if __name__ in ("__main__", "__mp_main__"):
+    sys.modules["app"] = sys.modules[__name__]
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -27,34 +42,52 @@ with open(APP_CONF_FILE, 'r') as f:
 with open(LOG_CONF_FILE, 'r') as f:
     log_config = yaml.safe_load(f.read())
 
-logging.config.dictConfig(log_config)
-logger = logging.getLogger('basicLogger')
-logger.info("App Conf File: %s" % APP_CONF_FILE)
-logger.info("Log Conf File: %s" % LOG_CONF_FILE)
+# Handlers run on a background thread (log_setup.py), so logging calls do not wait for the disk
+logger = setup_logging(log_config)
+logger.info("App Conf File: %s", APP_CONF_FILE)
+logger.info("Log Conf File: %s", LOG_CONF_FILE)
 
 
-CURRENT_ENTRY = 0
-max_retries = app_config["events"]["max_retries"]
+# Fraction of requests whose per-event INFO lines are logged
+LOG_EVENT = EventSampler(app_config.get("logging", {}).get("event_sample_rate", 1.0))
 
-while CURRENT_ENTRY < max_retries:
-    try:
-        logger.info(f"Trying to connect to Kafka. Current retry count: {CURRENT_ENTRY}")
-        client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
+PRODUCE_REJECTED = Counter("produce_rejected_total", "Events rejected with a 503 because the producer queue was full")
+
+# sync: every request waits for the broker ack. async: requests are queued and produced in batches.
+PRODUCER_CONFIG = app_config.get("producer", {})
+
+# Wire format of the event messages (event_codec.py): json, or compact once every consumer of the events topic
+# (storage, processing, audit_log) runs a version that decodes it
+EVENT_FORMAT = PRODUCER_CONFIG.get("format", "json")
+if EVENT_FORMAT not in FORMATS:
+    raise ValueError("Unknown event format %s, expected one of %s" % (EVENT_FORMAT, ", ".join(FORMATS)))
+
+# Most bookings a batch request can hold (at most producer.max_queued_messages, or it never fits the queue)
+MAX_BATCH_ITEMS = app_config.get("batch", {}).get("max_items", 1000)
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# An NDJSON line that is not JSON, so it gets its own error instead of failing the whole batch
+INVALID_LINE = object()
+
+def setup_producers(client):
+    """ Producers for the events and event_log topics """
+
+    # First Topic events
+    first_topic = client.topics[str.encode(app_config["events"]["topics"][0])]
+    if PRODUCER_CONFIG.get("mode", "sync") == "async":
+        producer_one = EventProducer(first_topic, PRODUCER_CONFIG)
+        atexit.register(producer_one.stop)
+    else:
+        producer_one = make_producer(first_topic, PRODUCER_CONFIG, partitioner=hashing_partitioner)
 
-        # First Topic events
-        first_topic = client.topics[str.encode(app_config["events"]["topics"][0])]
-        first_producer = first_topic.get_sync_producer()
+    # Second Topic event_log
+    second_topic = client.topics[str.encode(app_config["events"]["topics"][1])]
+    producer_two = make_producer(second_topic, PRODUCER_CONFIG)
 
-        # Second Topic event_log
-        second_topic = client.topics[str.encode(app_config["events"]["topics"][1])]
-        second_producer = second_topic.get_sync_producer()
+    return producer_one, producer_two
 
-        break
 
-    except:
-        logger.error("Connection failed.")
-        time.sleep(app_config["events"]["sleep_time"])
-        CURRENT_ENTRY += 1
+first_producer, second_producer = connect(app_config["events"], logger, setup_producers) or (None, None)
 
 
 def load(producer_two):
@@ -72,57 +105,231 @@ def load(producer_two):
         producer_two.produce(ready_msg_str.encode('utf-8'))
 
 
-def book_hotel_room(body):
-    """ Receives a hotel room booking event """
+def produce_event(message, hotel_id):
+    """ Sends an encoded event message to the events topic, partitioned by hotel. Returns False when the async queue is full """
+
+    partition_key = hotel_id.encode('utf-8')
+
+    if isinstance(first_producer, EventProducer):
+        if not first_producer.produce(message, partition_key):
+            PRODUCE_REJECTED.inc()
+            return False
+        return True
+
+    start = time.perf_counter()
+    first_producer.produce(message, partition_key=partition_key)
+    PRODUCE_LATENCY.observe(time.perf_counter() - start)
+    return True
+
+
+def produce_events(messages):
+    """ Sends encoded (event message, partition key) pairs to the events topic together. Returns False, sending none, when the async queue cannot take all of them """
+
+    if isinstance(first_producer, EventProducer):
+        if not first_producer.produce_many(messages):
+            PRODUCE_REJECTED.inc(len(messages))
+            return False
+        return True
+
+    # The sync producer still waits for the ack of every message
+    for message, partition_key in messages:
+        start = time.perf_counter()
+        first_producer.produce(message, partition_key=partition_key)
+        PRODUCE_LATENCY.observe(time.perf_counter() - start)
+    return True
+
+
+# Name of each event type in the log lines
+EVENT_NAMES = {
+    "hotel_room": "Hotel Room Booking",
+    "hotel_activity": "Hotel Activity Booking"
+}
+
+
+def encode_event(event_type, body):
+    """ Stamps a booking with a new trace id and encodes it as an event message for the events topic, in EVENT_FORMAT """
 
     trace_id = uuid.uuid4()
     body["trace_id"] = str(trace_id)
 
-    logger.info("Received event Hotel Room Booking request with a trace id of %s", body["trace_id"])
-
     # First Topic (events)
     msg = {
-        "type": "hotel_room",
+        "type": event_type,
         "datetime": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
         "payload": body
     }
-    msg_str = json.dumps(msg)
-    first_producer.produce(msg_str.encode('utf-8'))
+    return encode_message(msg, EVENT_FORMAT)
+
+
+def book_event(event_type, body):
+    """ Produces a booking event and returns the response status """
+
+    message = encode_event(event_type, body)
+
+    log_event = LOG_EVENT()
+    if log_event:
+        logger.info("Received event %s request with a trace id of %s", EVENT_NAMES[event_type], body["trace_id"])
+
+    if not produce_event(message, body["hotel_id"]):
+        logger.error("Producer queue is full. Rejected %s request with a trace id of %s", EVENT_NAMES[event_type], body["trace_id"])
+        return 503
+
+    if log_event:
+        logger.info("Returned event %s response (Id: %s) with status %d", EVENT_NAMES[event_type], body["trace_id"], 201)
+
+    return 201
+
+
+async def book_event_async(event_type, body):
+    """ book_event() on the event loop of the ASGI mode """
+
+    # The async producer only queues the message, so it is called on the loop.
+    # The sync producer waits for the broker ack, which happens on a thread so the loop keeps serving requests.
+    if isinstance(first_producer, EventProducer):
+        return book_event(event_type, body)
 
-    logger.info(f"Returned event Hotel Room Booking response (Id: ${body['trace_id']}) with status 201")
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, book_event, event_type, body)
+
+
+def book_hotel_room(body):
+    """ Receives a hotel room booking event """
+    return NoContent, book_event("hotel_room", body)
 
-    # return NoContent, response.status_code
-    return NoContent, 201
 
 def book_hotel_activity(body):
     """ Receives a hotel activity reservation event """
+    return NoContent, book_event("hotel_activity", body)
 
-    trace_id = uuid.uuid4()
-    body["trace_id"] = str(trace_id)
 
+def parse_batch(body, content_type):
+    """ The bookings of a batch body: a JSON array, or one JSON object per line (NDJSON). None when it is neither """
 
-    logger.info("Received event Hotel Activity Booking request with a trace id of %s", body["trace_id"])
+    try:
+        text = body.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+    if content_type.startswith(NDJSON_MIMETYPE):
+        items = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(INVALID_LINE)
+        return items
 
-    # First Topic (events)
-    msg = {
-        "type": "hotel_activity",
-        "datetime": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-        "payload": body
-    }
-    msg_str = json.dumps(msg)
-    first_producer.produce(msg_str.encode('utf-8'))
+    try:
+        items = json.loads(text)
+    except ValueError:
+        return None
+    return items if isinstance(items, list) else None
 
-    logger.info("Returned event Hotel Activity Booking response (Id: %s) with status %d", body["trace_id"], 201)
 
-    # return NoContent, response.status_code
-    return NoContent, 201
+def validation_error(validator, item):
+    """ Why a booking does not match its schema, in the words connexion uses for a single POST. None when it matches """
+
+    if item is INVALID_LINE:
+        return "Line is not valid JSON"
+
+    try:
+        validator.validate(item)
+    except ValidationError as exception:
+        error_path = ".".join(str(part) for part in exception.path)
+        return exception.message + (" - '%s'" % error_path if error_path else "")
+    return None
+
+
+def book_batch(event_type, body):
+    """ Validates every booking of a batch, produces the valid ones together and reports the status of each """
+
+    items = parse_batch(body, request.headers.get("Content-Type", ""))
+    if items is None:
+        return {"message": "The body must be a JSON array or %s" % NDJSON_MIMETYPE}, 400
+    if len(items) > MAX_BATCH_ITEMS:
+        return {"message": "At most %d bookings per request" % MAX_BATCH_ITEMS}, 413
+
+    results = []
+    messages = []
+    for index, item in enumerate(items):
+        error = validation_error(ITEM_VALIDATORS[event_type], item)
+        if error is not None:
+            results.append({"index": index, "status": 400, "detail": error})
+            continue
+
+        messages.append((encode_event(event_type, item), item["hotel_id"].encode('utf-8')))
+        results.append({"index": index, "status": 201, "trace_id": item["trace_id"]})
+
+    status = 200
+    if messages and not produce_events(messages):
+        logger.error("Producer queue is full. Rejected a batch of %d %s requests", len(messages), EVENT_NAMES[event_type])
+        for result in results:
+            if result["status"] == 201:
+                result["status"] = 503
+                del result["trace_id"]
+        status = 503
+
+    accepted = sum(1 for result in results if result["status"] == 201)
+    logger.info("Received a batch of %d %s requests, %d accepted", len(items), EVENT_NAMES[event_type], accepted)
+
+    return {"accepted": accepted, "rejected": len(results) - accepted, "items": results}, status
+
+
+def book_hotel_rooms_batch(body):
+    """ Receives a batch of hotel room booking events """
+    return book_batch("hotel_room", body)
+
+
+def book_hotel_activities_batch(body):
+    """ Receives a batch of hotel activity reservation events """
+    return book_batch("hotel_activity", body)
+
+
+async def book_hotel_room_async(body):
+    """ Receives a hotel room booking event in the ASGI mode """
+    return await book_event_async("hotel_room", body)
+
+
+async def book_hotel_activity_async(body):
+    """ Receives a hotel activity reservation event in the ASGI mode """
+    return await book_event_async("hotel_activity", body)
 
 
 app = connexion.FlaskApp(__name__, specification_dir="")
-app.add_api("openapi.yaml",
-            strict_validation=True,
-            validate_responses=True)
+api = app.add_api("openapi.yaml",
+                  strict_validation=True,
+                  validate_responses=True)
+init_metrics(app, api)
+
+# connexion does not validate the batch bodies (they are not only JSON), the handlers validate each booking instead
+ITEM_VALIDATORS = {
+    "hotel_room": Draft4RequestValidator(api.specification["components"]["schemas"]["HotelRoomBooking"],
+                                         format_checker=draft4_format_checker),
+    "hotel_activity": Draft4RequestValidator(api.specification["components"]["schemas"]["HotelActivityBooking"],
+                                             format_checker=draft4_format_checker)
+}
+
+# flask: app.run, Flask's development server. asgi: uvicorn with server.workers processes (asgi_server.py)
+SERVER_CONFIG = app_config.get("server", {})
+
+if SERVER_CONFIG.get("mode", "flask") == "asgi":
+    # Only the asgi mode needs uvicorn and asgiref
+    from asgi_server import ReceiverASGI
+    asgi_app = ReceiverASGI(app.app, api, {"app.book_hotel_room": book_hotel_room_async,
+                                           "app.book_hotel_activity": book_hotel_activity_async})
 
 if __name__ == "__main__":
     load(second_producer)
-    app.run(port=8080)
+    if SERVER_CONFIG.get("mode", "flask") == "asgi":
+        import uvicorn
+        workers = SERVER_CONFIG.get("workers", 1)
+        # Worker processes import the app themselves, each with its own producers
+        uvicorn.run(asgi_app if workers == 1 else "app:asgi_app",
+                    host=SERVER_CONFIG.get("host", "0.0.0.0"),
+                    port=SERVER_CONFIG.get("port", 8080),
+                    workers=workers,
+                    access_log=False)
+    else:
+        app.run(port=SERVER_CONFIG.get("port", 8080))
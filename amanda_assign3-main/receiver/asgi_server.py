@@ -0,0 +1,129 @@
+"""
+ASGI serving mode of the receiver (server.mode: asgi in app_conf.yml), run by uvicorn
+
+The booking POSTs never leave uvicorn's event loop: their body is validated against the request schema in
+openapi.yaml the same way connexion does it, and the event is handed to the producer without blocking the loop
+(book_event_async in app.py). Every other request (/metrics, /ui, the spec) goes to the connexion Flask app
+through asgiref's WSGI adapter.
+
+uvicorn is installed with its standard extras: on the uvloop event loop every connection has TCP_NODELAY set. The
+plain asyncio loop does not set it on the socket uvicorn shares between worker processes, so keep-alive
+connections would wait ~40 ms for a delayed ACK on every response that is written in two pieces.
+"""
+import json
+import time
+import logging
+
+from asgiref.wsgi import WsgiToAsgi
+from jsonschema import ValidationError, draft4_format_checker
+from connexion.json_schema import Draft4RequestValidator
+
+from metrics import REQUEST_LATENCY
+
+
+logger = logging.getLogger('basicLogger')
+
+# With a content-length, the empty responses are written in one piece instead of chunked
+EMPTY_HEADERS = [(b"content-length", b"0")]
+
+
+def problem(status, title, detail):
+    """ A Problem Details response like the ones connexion returns, as (status, headers, body) """
+    body = json.dumps({"type": "about:blank", "title": title, "detail": detail, "status": status}).encode('utf-8')
+    return status, [(b"content-type", b"application/problem+json"), (b"content-length", b"%d" % len(body))], body
+
+
+class ReceiverASGI:
+    """ ASGI app serving the operations that have a coroutine handler on the event loop, and the rest with Flask """
+
+    def __init__(self, flask_app, api, handlers):
+        """ handlers maps an operationId to the coroutine function handling its (validated) request body """
+        self.wsgi_app = WsgiToAsgi(flask_app)
+
+        # (method, path) of every operation served on the event loop
+        self.routes = {}
+        for path, path_item in api.specification["paths"].items():
+            for method, operation in path_item.items():
+                if not isinstance(operation, dict) or operation.get("operationId") not in handlers:
+                    continue
+                schema = operation["requestBody"]["content"]["application/json"]["schema"]
+                validator = Draft4RequestValidator(schema, format_checker=draft4_format_checker)
+                self.routes[(method.upper(), api.base_path + path)] = (operation["operationId"],
+                                                                       handlers[operation["operationId"]],
+                                                                       validator)
+
+    async def __call__(self, scope, receive, send):
+        """ ASGI entry point """
+
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        route = self.routes.get((scope["method"], scope["path"])) if scope["type"] == "http" else None
+        if route is None:
+            await self.wsgi_app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+
+        body = await self.read_body(receive)
+        if body is None:
+            # The client went away before sending the whole body
+            return
+
+        operation_id, handler, validator = route
+        status, headers, content = await self.handle(scope, body, handler, validator)
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": content})
+
+        REQUEST_LATENCY.labels(operation_id).observe(time.perf_counter() - start)
+
+    async def handle(self, scope, body, handler, validator):
+        """ Validates the request like connexion (strict_validation=True) and runs the handler """
+
+        if scope["query_string"]:
+            return problem(400, "Bad Request", "Extra query parameter(s) %s not in spec"
+                           % scope["query_string"].decode('latin-1'))
+
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return problem(400, "Bad Request", "Request body is not valid JSON")
+
+        try:
+            validator.validate(data)
+        except ValidationError as exception:
+            error_path = ".".join(str(item) for item in exception.path)
+            return problem(400, "Bad Request", exception.message + (" - '%s'" % error_path if error_path else ""))
+
+        try:
+            status = await handler(data)
+        except:
+            logger.exception("Failed to handle a request to %s", scope["path"])
+            return problem(500, "Internal Server Error", "The server encountered an internal error")
+
+        return status, EMPTY_HEADERS, b""
+
+    @staticmethod
+    async def read_body(receive):
+        """ The whole request body, or None when the client disconnected """
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    @staticmethod
+    async def lifespan(receive, send):
+        """ Nothing to start or stop: the producers are created when app.py is imported """
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
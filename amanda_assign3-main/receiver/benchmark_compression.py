@@ -0,0 +1,243 @@
+"""
+Benchmark: broker disk use and throughput of the events topic per producer compression (producer.compression)
+
+Usage: python3 benchmark_compression.py [--events 100000] [--batch-sizes 1,10,100,500]
+                                        [--hosts kafka:9092 --kafka-log-dir /kafka/kafka-logs]
+
+Without --hosts, nothing but this process is needed: the booking events are encoded like the receiver encodes
+them (event_codec.py, json and compact) and grouped into batches the way the producer sends them to Kafka, one
+message set per partition and request. With compression, Kafka stores each batch as one wrapper message whose
+value is the compressed message set, so the disk use is modelled from the magic v1 message format (broker_version
+0.10.0): 12 bytes of log overhead (offset, size) and 22 bytes of message header (crc, magic, attributes,
+timestamp, key and value lengths) per message, plus the key and value. The codec time is what the producer pays
+to compress a batch and every consumer pays to decompress it, and "msgs/s" is the throughput the codec alone
+would allow end to end.
+
+With --hosts, the same events are also produced through make_producer() (async, batch_size and linger_ms from
+app_conf.yml) to a topic per codec on that Kafka broker and read back by a consumer, for the produce and end to
+end throughput. With --kafka-log-dir (the broker's log.dirs, mapped to a volume in docker-compose.yml), the size
+of each topic on disk is reported as well.
+"""
+import os
+import gzip
+import time
+import uuid
+import random
+import struct
+import argparse
+
+import yaml
+
+from broker import get_client, make_producer, hashing_partitioner, OffsetType
+from event_codec import encode_message, decode_message, FORMATS
+
+
+# Bytes Kafka stores around every (v1) message besides its key and value
+LOG_OVERHEAD = 12
+MESSAGE_HEADER = 22
+
+
+def load_codecs():
+    """ (compress, decompress) of every codec whose library is installed """
+    codecs = {"none": None, "gzip": (gzip.compress, gzip.decompress)}
+
+    try:
+        import snappy
+        codecs["snappy"] = (snappy.compress, snappy.decompress)
+    except ImportError:
+        print("python-snappy is not installed, skipping snappy")
+
+    try:
+        import lz4.frame
+        codecs["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+    except ImportError:
+        print("lz4 is not installed, skipping lz4")
+
+    return codecs
+
+
+def make_events(num_events):
+    """ Hotel room and hotel activity event messages like the ones produced by the receiver, with their hotel id """
+    events = []
+    for i in range(num_events):
+        hotel_id = "CA-%02d" % random.randint(1, 20)
+        if i % 2 == 0:
+            payload = {
+                "hotel_id": hotel_id,
+                "customer_id": str(uuid.uuid4()),
+                "room_id": "A%03d" % random.randint(100, 999),
+                "room_type": random.choice(["Single Bed", "Double Bed", "Queen Bed", "Suite"]),
+                "num_of_people": random.randint(1, 4),
+                "check_in_date": "2023-08-%02d" % random.randint(1, 28),
+                "check_out_date": "2023-09-%02d" % random.randint(1, 28),
+                "timestamp": "2023-07-29T09:12:%02d.%03dZ" % (random.randint(0, 59), random.randint(0, 999)),
+                "trace_id": str(uuid.uuid4())
+            }
+            events.append(({"type": "hotel_room", "datetime": "2023-07-29T09:12:33", "payload": payload}, hotel_id))
+        else:
+            payload = {
+                "hotel_id": hotel_id,
+                "customer_id": str(uuid.uuid4()),
+                "activity_id": "C%d" % random.randint(1, 9),
+                "activity_name": random.choice(["Rock Climbing", "Kayaking", "Wine Tasting", "City Tour"]),
+                "num_of_people": random.randint(1, 5),
+                "reservation_date": "2023-08-%02d" % random.randint(1, 28),
+                "timestamp": "2023-08-08T09:12:%02d.%03dZ" % (random.randint(0, 59), random.randint(0, 999)),
+                "trace_id": str(uuid.uuid4())
+            }
+            events.append(({"type": "hotel_activity", "datetime": "2023-08-08T09:12:33", "payload": payload}, hotel_id))
+    return events
+
+
+def message_set(messages):
+    """ A v1 message set of (value, key) pairs, as the broker stores it uncompressed """
+    timestamp = int(time.time() * 1000)
+    parts = []
+    for value, key in messages:
+        header = struct.pack(">qiIbbqi", 0, MESSAGE_HEADER + len(key) + len(value), 0, 1, 0, timestamp, len(key))
+        parts.append(header + key + struct.pack(">i", len(value)) + value)
+    return b"".join(parts)
+
+
+def model_codec(batches, codec):
+    """ Bytes on disk, compress and decompress seconds of the batches with one codec """
+    disk_bytes = 0
+    compress_sec = 0
+    decompress_sec = 0
+
+    for batch in batches:
+        uncompressed = message_set(batch)
+        if codec is None:
+            disk_bytes += len(uncompressed)
+            continue
+
+        compress, decompress = codec
+        start = time.perf_counter()
+        compressed = compress(uncompressed)
+        compress_sec += time.perf_counter() - start
+
+        start = time.perf_counter()
+        assert decompress(compressed) == uncompressed
+        decompress_sec += time.perf_counter() - start
+
+        # The wrapper message has no key
+        disk_bytes += LOG_OVERHEAD + MESSAGE_HEADER + len(compressed)
+
+    return disk_bytes, compress_sec, decompress_sec
+
+
+def make_batches(encoded, batch_size, partitions):
+    """ Splits the (value, key) messages into the batches the producer sends: per partition, batch_size at a time """
+    by_partition = {}
+    for value, key in encoded:
+        by_partition.setdefault(hashing_partitioner(list(range(partitions)), key), []).append((value, key))
+
+    batches = []
+    for messages in by_partition.values():
+        batches.extend(messages[i:i + batch_size] for i in range(0, len(messages), batch_size))
+    return batches
+
+
+def run_model(events, codecs, batch_sizes, partitions):
+    """ Modelled disk use and codec time of every wire format, batch size and codec """
+
+    print("%-8s %6s %-7s %10s %7s %12s %14s %10s" % ("format", "batch", "codec", "disk B/msg", "ratio",
+                                                      "compress us", "decompress us", "msgs/s"))
+    for wire_format in FORMATS:
+        encoded = [(encode_message(event, wire_format), hotel_id.encode('utf-8')) for event, hotel_id in events]
+
+        for batch_size in batch_sizes:
+            batches = make_batches(encoded, batch_size, partitions)
+            uncompressed_bytes = None
+
+            for name, codec in codecs.items():
+                disk_bytes, compress_sec, decompress_sec = model_codec(batches, codec)
+                if uncompressed_bytes is None:
+                    uncompressed_bytes = disk_bytes
+                codec_sec = compress_sec + decompress_sec
+                print("%-8s %6d %-7s %10.1f %7.2f %12.2f %14.2f %10s" % (
+                    wire_format, batch_size, name, disk_bytes / len(events), uncompressed_bytes / disk_bytes,
+                    compress_sec / len(events) * 1e6, decompress_sec / len(events) * 1e6,
+                    "%.0f" % (len(events) / codec_sec) if codec_sec else "-"))
+        print()
+
+
+def topic_disk_bytes(log_dir, topic_name):
+    """ Size of the log segments of every partition of a topic in the broker's log directory """
+    total = 0
+    for entry in os.listdir(log_dir):
+        if entry.rsplit("-", 1)[0] == topic_name:
+            partition_dir = os.path.join(log_dir, entry)
+            total += sum(os.path.getsize(os.path.join(partition_dir, f))
+                         for f in os.listdir(partition_dir) if f.endswith(".log"))
+    return total
+
+
+def run_kafka(events, codecs, args):
+    """ Produces the events to a topic per codec on a Kafka broker and reads them back """
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_conf.yml"), 'r') as f:
+        producer_config = yaml.safe_load(f.read()).get("producer", {})
+
+    hostname, port = args.hosts.rsplit(":", 1)
+    client = get_client({"hostname": hostname, "port": int(port), "broker_version": args.broker_version})
+    encoded = [(encode_message(event, args.format), hotel_id.encode('utf-8')) for event, hotel_id in events]
+
+    print("%-7s %14s %16s %12s" % ("codec", "produce msgs/s", "end to end msgs/s", "disk B/msg"))
+    run_id = uuid.uuid4().hex[:8]
+    for name in codecs:
+        topic_name = "compression_bench_%s_%s" % (name, run_id)
+        topic = client.topics[topic_name.encode('utf-8')]
+        config = dict(producer_config, compression=name)
+
+        start = time.perf_counter()
+        producer = make_producer(topic, config, sync=False, partitioner=hashing_partitioner)
+        for value, key in encoded:
+            producer.produce(value, partition_key=key)
+        # Waits until every message was delivered
+        producer.stop()
+        produce_sec = time.perf_counter() - start
+
+        consumer = topic.get_simple_consumer(auto_offset_reset=OffsetType.EARLIEST, reset_offset_on_start=True,
+                                             consumer_timeout_ms=10000)
+        consumed = 0
+        for msg in consumer:
+            decode_message(msg.value)
+            consumed += 1
+            if consumed == len(encoded):
+                break
+        end_to_end_sec = time.perf_counter() - start
+        consumer.stop()
+
+        if consumed < len(encoded):
+            print("%-7s only %d of %d messages were consumed" % (name, consumed, len(encoded)))
+            continue
+
+        disk = "-"
+        if args.kafka_log_dir:
+            disk = "%.1f" % (topic_disk_bytes(args.kafka_log_dir, topic_name) / len(encoded))
+        print("%-7s %14.0f %16.0f %12s" % (name, len(encoded) / produce_sec, len(encoded) / end_to_end_sec, disk))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Disk use and throughput of the events topic per compression codec")
+    parser.add_argument("--events", type=int, default=100000, help="booking events to send")
+    parser.add_argument("--batch-sizes", default="1,10,100,500", help="messages per producer batch (model only)")
+    parser.add_argument("--partitions", type=int, default=1, help="partitions of the events topic (model only)")
+    parser.add_argument("--hosts", help="host:port of a Kafka broker to also produce to")
+    parser.add_argument("--broker-version", default="0.10.0", help="events.broker_version of the client")
+    parser.add_argument("--format", default="compact", choices=FORMATS, help="wire format of the messages (Kafka only)")
+    parser.add_argument("--kafka-log-dir", help="the broker's log directory, to measure the topics on disk")
+    args = parser.parse_args()
+
+    codecs = load_codecs()
+
+    events = make_events(args.events)
+    run_model(events, codecs, [int(size) for size in args.batch_sizes.split(",")], args.partitions)
+
+    if args.hosts:
+        run_kafka(events, codecs, args)
+
+
+if __name__ == "__main__":
+    main()
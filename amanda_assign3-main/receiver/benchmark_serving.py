@@ -0,0 +1,185 @@
+"""
+Benchmark: requests/s and p99 latency of the receiver served by app.run (Flask's development server) and by
+uvicorn in the ASGI mode (asgi_server.py), at 1, 4 and 16 concurrent clients
+
+Usage: python3 benchmark_serving.py [duration_sec] [asgi_workers]
+
+Each mode runs app.py in a process of its own, with the local broker backend (broker.py, topics as log files in a
+temporary directory) and the async producer, so Kafka and the network are not part of the measurement. Every
+client is a process POSTing hotel room bookings back to back over one keep-alive connection for duration_sec
+seconds.
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import socket
+import tempfile
+import subprocess
+import multiprocessing
+
+import yaml
+import requests
+
+
+RECEIVER_DIR = os.path.dirname(os.path.abspath(__file__))
+CLIENTS = [1, 4, 16]
+
+
+def make_booking():
+    """ A hotel room booking payload """
+    return {
+        "hotel_id": "CA-%02d" % random.randint(1, 20),
+        "customer_id": str(uuid.uuid4()),
+        "room_id": "A%03d" % random.randint(100, 999),
+        "room_type": "Single Bed",
+        "num_of_people": random.randint(1, 4),
+        "check_in_date": "2023-08-08",
+        "check_out_date": "2023-08-13",
+        "timestamp": "2023-07-29T09:12:33.001Z"
+    }
+
+
+def free_port():
+    """ A port nothing listens on """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_config(config_dir, server_config, port):
+    """ app_conf.yml (local broker, async producer) and log_conf.yml (log file in config_dir) of one run """
+
+    with open(os.path.join(RECEIVER_DIR, "app_conf.yml"), 'r') as f:
+        app_config = yaml.safe_load(f.read())
+    app_config["events"].update({"backend": "local", "log_dir": os.path.join(config_dir, "broker"),
+                                 "partitions": {"events": 4}, "max_retries": 1, "sleep_time": 0})
+    app_config["producer"]["mode"] = "async"
+    app_config["server"] = dict(server_config, host="127.0.0.1", port=port)
+
+    with open(os.path.join(RECEIVER_DIR, "log_conf.yml"), 'r') as f:
+        log_config = yaml.safe_load(f.read())
+    log_config["handlers"]["file"]["filename"] = os.path.join(config_dir, "app_receiver.log")
+
+    os.makedirs(app_config["events"]["log_dir"])
+    with open(os.path.join(config_dir, "app_conf.yml"), 'w') as f:
+        yaml.safe_dump(app_config, f)
+    with open(os.path.join(config_dir, "log_conf.yml"), 'w') as f:
+        yaml.safe_dump(log_config, f)
+
+
+def start_receiver(config_dir, url):
+    """ Runs app.py with the configuration in config_dir and waits until it serves requests """
+
+    # app.py reads app_conf.yml / log_conf.yml from the working directory
+    process = subprocess.Popen([sys.executable, os.path.join(RECEIVER_DIR, "app.py")], cwd=config_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            if requests.get(url + "/metrics", timeout=1).status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+
+    process.kill()
+    raise RuntimeError("The receiver did not start, see %s" % os.path.join(config_dir, "app_receiver.log"))
+
+
+def stop_receiver(process):
+    """ Stops the receiver (and its workers) """
+    process.terminate()
+    try:
+        process.wait(15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def send_bookings(url, start, duration, results):
+    """ Client process: POSTs bookings back to back from start until start + duration """
+    session = requests.Session()
+    latencies = []
+    errors = 0
+
+    time.sleep(max(0, start - time.time()))
+    deadline = start + duration
+    while time.time() < deadline:
+        sent = time.perf_counter()
+        try:
+            status = session.post(url, json=make_booking(), timeout=10).status_code
+        except requests.RequestException:
+            status = None
+        if status == 201:
+            latencies.append(time.perf_counter() - sent)
+        else:
+            errors += 1
+
+    results.put((latencies, errors))
+
+
+def run_clients(url, num_clients, duration):
+    """ Runs num_clients client processes at once. Returns (requests/s, p50 ms, p99 ms, errors) """
+
+    results = multiprocessing.Queue()
+    # Every client starts at the same time, once all of them are up
+    start = time.time() + 0.5 + 0.05 * num_clients
+    clients = [multiprocessing.Process(target=send_bookings, args=(url, start, duration, results))
+               for _ in range(num_clients)]
+    for client in clients:
+        client.start()
+
+    latencies = []
+    errors = 0
+    for _ in clients:
+        client_latencies, client_errors = results.get()
+        latencies.extend(client_latencies)
+        errors += client_errors
+    for client in clients:
+        client.join()
+
+    latencies.sort()
+    if not latencies:
+        return 0, 0, 0, errors
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+    return len(latencies) / duration, percentile(50), percentile(99), errors
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    asgi_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    modes = [
+        ("app.run", {"mode": "flask"}),
+        ("asgi, 1 worker", {"mode": "asgi", "workers": 1}),
+        ("asgi, %d workers" % asgi_workers, {"mode": "asgi", "workers": asgi_workers})
+    ]
+
+    work_dir = tempfile.mkdtemp()
+    print("%-18s %8s %12s %10s %10s %8s" % ("mode", "clients", "requests/s", "p50 ms", "p99 ms", "errors"))
+
+    for i, (label, server_config) in enumerate(modes):
+        config_dir = os.path.join(work_dir, "run%d" % i)
+        port = free_port()
+        url = "http://127.0.0.1:%d" % port
+        write_config(config_dir, server_config, port)
+
+        process = start_receiver(config_dir, url)
+        try:
+            # Warm up the connections and the validators
+            run_clients(url + "/booking/hotel-rooms", 1, 1)
+            for num_clients in CLIENTS:
+                rate, p50, p99, errors = run_clients(url + "/booking/hotel-rooms", num_clients, duration)
+                print("%-18s %8d %12.0f %10.2f %10.2f %8d" % (label, num_clients, rate, p50, p99, errors))
+        finally:
+            stop_receiver(process)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Wire format of the event messages on the events topic
+
+The first byte of a message says how the rest of it is encoded, so consumers read both formats while the
+producers move from one to the other:
+
+- "{" (json): {"type": ..., "datetime": ..., "payload": {...}}, the format the receiver has always written
+- 0x01 (compact, version 1): a msgpack array of the schema id, the datetime and the value of every field of the
+  schema, in the schema's order. The field names are in SCHEMAS instead of in every message.
+
+A schema is never changed once messages were written with it: another field list gets a new schema id. Fields of
+a payload that are not in its schema are not encoded.
+"""
+import json
+
+import msgpack
+
+
+JSON_FORMAT = ord("{")
+COMPACT_FORMAT = 1
+COMPACT_HEADER = bytes((COMPACT_FORMAT,))
+
+FORMATS = ("json", "compact")
+
+# Schema id: (event type, payload fields in the order they are encoded)
+SCHEMAS = {
+    1: ("hotel_room", ["hotel_id", "customer_id", "room_id", "room_type", "num_of_people",
+                       "check_in_date", "check_out_date", "timestamp", "trace_id"]),
+    2: ("hotel_activity", ["hotel_id", "customer_id", "activity_id", "activity_name", "num_of_people",
+                           "reservation_date", "timestamp", "trace_id"])
+}
+
+# The schema new messages of each event type are written with
+SCHEMA_IDS = {event_type: schema_id for schema_id, (event_type, _) in SCHEMAS.items()}
+
+
+def encode_message(msg, wire_format="json"):
+    """ Encodes an event message ({"type", "datetime", "payload"}) in the json or compact format """
+
+    if wire_format == "json" or msg["type"] not in SCHEMA_IDS:
+        return json.dumps(msg).encode('utf-8')
+
+    schema_id = SCHEMA_IDS[msg["type"]]
+    payload = msg["payload"]
+    values = [schema_id, msg["datetime"]]
+    values.extend(payload.get(field) for field in SCHEMAS[schema_id][1])
+
+    return COMPACT_HEADER + msgpack.packb(values, use_bin_type=True)
+
+
+def decode_message(value):
+    """ Decodes an event message in either format into {"type", "datetime", "payload"} """
+
+    # Messages stored as text before the compact format existed (e.g. in the audit index)
+    if isinstance(value, str):
+        return json.loads(value)
+
+    if value[0] == JSON_FORMAT:
+        return json.loads(value.decode('utf-8'))
+
+    if value[0] != COMPACT_FORMAT:
+        raise ValueError("Unknown event message format %d" % value[0])
+
+    values = msgpack.unpackb(value[1:], raw=False)
+    if values[0] not in SCHEMAS:
+        raise ValueError("Unknown event schema %s" % values[0])
+    event_type, fields = SCHEMAS[values[0]]
+    return {"type": event_type, "datetime": values[1], "payload": dict(zip(fields, values[2:]))}
@@ -0,0 +1,110 @@
+import time
+import queue
+import logging
+from threading import Thread, Lock
+
+from prometheus_client import Histogram
+
+from broker import hashing_partitioner, make_producer
+from event_codec import decode_message
+
+
+logger = logging.getLogger('basicLogger')
+
+_STOP = object()
+
+PRODUCE_LATENCY = Histogram("produce_latency_seconds", "Time from handing an event to the producer until the broker acknowledged it")
+
+
+class EventProducer:
+    """
+    Asynchronous, batching producer for the events topic
+
+    Requests only put the encoded message (or a batch of them) on a bounded in-memory queue. A single sender
+    thread hands the messages to an async pykafka producer, which batches them (batch_size / linger_ms) and
+    reports delivery back to that same thread. When the queue is full produce() returns False instead of
+    blocking the request.
+    """
+
+    def __init__(self, topic, producer_config):
+        """ Initializes the producer with the producer section of app_conf.yml and starts the sender thread """
+        # Each queue entry is a batch of messages, so the bound is on the messages in all of them
+        self.queue = queue.Queue()
+        self.max_queued_messages = producer_config.get("max_queued_messages", 10000)
+        self.queued_messages = 0
+        self.lock = Lock()
+        # Messages with the same partition key (hotel id) always go to the same partition, which keeps their order
+        self.producer = make_producer(topic, producer_config,
+                                      sync=False,
+                                      partitioner=hashing_partitioner,
+                                      delivery_reports=True,
+                                      max_queued_messages=self.max_queued_messages,
+                                      block_on_queue_full=True)
+        # Messages waiting for their delivery report, by id, with the time they were queued
+        self.pending = {}
+        self.sender = Thread(target=self._send_messages)
+        self.sender.setDaemon(True)
+        self.sender.start()
+
+    def produce(self, message, partition_key=None):
+        """ Queues an encoded message. Returns False when the queue is full (the caller should shed load) """
+        return self.produce_many([(message, partition_key)])
+
+    def produce_many(self, messages):
+        """ Queues (encoded message, partition key) pairs together. Returns False, queueing none of them, when they do not all fit """
+        with self.lock:
+            if self.queued_messages + len(messages) > self.max_queued_messages:
+                return False
+            self.queued_messages += len(messages)
+        self.queue.put((messages, time.perf_counter()))
+        return True
+
+    def stop(self, timeout=10):
+        """ Sends everything that is still queued, then stops the underlying producer """
+        self.queue.put((_STOP, None))
+        self.sender.join(timeout)
+
+    def _send_messages(self):
+        """ Sender thread: moves queued messages to the Kafka producer and checks delivery reports """
+        while True:
+            try:
+                messages, queued = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                messages = None
+
+            if messages is _STOP:
+                break
+            if messages is not None:
+                # A batch goes to the Kafka producer back to back, so it lands in as few produce requests as possible
+                for message, partition_key in messages:
+                    self.pending[id(message)] = (message, queued)
+                    self.producer.produce(message, partition_key=partition_key)
+                with self.lock:
+                    self.queued_messages -= len(messages)
+
+            self._check_delivery_reports()
+
+        # Stopping the producer flushes any batch that is still lingering
+        self.producer.stop()
+        self._check_delivery_reports()
+
+    def _check_delivery_reports(self):
+        """ Logs every message the broker failed to accept, by trace id """
+        while True:
+            try:
+                msg, exc = self.producer.get_delivery_report(block=False)
+            except queue.Empty:
+                return
+            _, queued = self.pending.pop(id(msg.value), (None, None))
+            if queued is not None:
+                PRODUCE_LATENCY.observe(time.perf_counter() - queued)
+            if exc is not None:
+                logger.error("Failed to deliver event with a trace id of %s: %s", trace_id_of(msg.value), exc)
+
+
+def trace_id_of(message):
+    """ Extracts the trace id from an encoded event message, in either format (only used on the failure path) """
+    try:
+        return decode_message(message)["payload"]["trace_id"]
+    except (ValueError, KeyError, TypeError, IndexError):
+        return "unknown"
@@ -1,23 +1,40 @@
 import os 
+import sys
 import json 
-import time 
+import time
 import datetime
-import logging
-import logging.config
 from threading import Thread
+from multiprocessing import Process
 import yaml
 
-from pykafka import KafkaClient
-from pykafka.common import OffsetType
+from prometheus_client import Histogram
+
+from broker import connect, make_producer, OffsetType
+from event_codec import decode_message
 
 import connexion 
+from flask import Response
 
 from sqlalchemy import create_engine
 from sqlalchemy import and_
+from sqlalchemy import func
 from sqlalchemy.orm import sessionmaker
 from base import Base
 from hotel_room import HotelRoom
 from hotel_activity import HotelActivity
+from event_trace import EventTrace
+from batch_writer import BatchWriter, EVENT_TABLES
+from partition_manager import maintain_configured
+from offset_store import OffsetStore
+from response_validator import sampled_response_validator
+from reservation_reader import encode_cursor, decode_cursor, select_reservations, rows_to_json, rows_to_ndjson
+from metrics import init_metrics
+from log_setup import setup_logging, EventSampler
+
+# connexion imports the module of the operationIds (app) by name. Run as python3 app.py, this module is __main__,
+# so without this alias it would be imported and run a second time (connecting and registering its metrics twice)
+if __name__ == "__main__":
+    sys.modules["app"] = sys.modules[__name__]
 
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
@@ -35,14 +52,31 @@ with open(APP_CONF_FILE, 'r') as f:
 with open(LOG_CONF_FILE, 'r') as f:
     log_config = yaml.safe_load(f.read())
 
-logging.config.dictConfig(log_config)
-logger = logging.getLogger('basicLogger')
+# Handlers run on a background thread (log_setup.py), so logging calls do not wait for the disk
+logger = setup_logging(log_config)
 logger.info("App Conf File: %s", APP_CONF_FILE)
 logger.info("Log Conf File: %s", LOG_CONF_FILE)
 
+# Fraction of consumed events whose per-event lines are logged
+LOG_EVENT = EventSampler(app_config.get("logging", {}).get("event_sample_rate", 1.0))
+
+# Number of consumer workers and whether they run as threads or processes. 
+# Each worker owns a share of the events partitions and uses its own connection from the pool.
+WORKER_CONFIG = app_config.get("consumers", {})
+
+# With exactly_once, the consumer offsets are stored in the database in the same transaction as each batch of events,
+# and the consumers start from them. The broker offsets are still committed, but only for monitoring.
+EXACTLY_ONCE = WORKER_CONFIG.get("exactly_once", False)
+
+# Partitions of the event tables by date_created and how long their rows are kept (see partition_manager.py)
+PARTITION_CONFIG = app_config.get("partitions", {})
+
+CONSUME_TO_COMMIT = Histogram("consume_to_commit_seconds", "Time from consuming an event until its batch is stored and its offset committed")
+BATCH_SIZE = Histogram("batch_size", "Events stored per batch", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
 DB_ENGINE = create_engine(
     f'mysql+pymysql://{app_config["datastore"]["user"]}:{app_config["datastore"]["password"]}@{app_config["datastore"]["hostname"]}:{app_config["datastore"]["port"]}/{app_config["datastore"]["db"]}',
-    pool_size=5, 
+    pool_size=5 + WORKER_CONFIG.get("workers", 1), 
     pool_recycle=3600, 
     pool_pre_ping=True 
     )
@@ -50,28 +84,26 @@ DB_ENGINE = create_engine(
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
-def process_messages():
+def process_messages(worker_id=0):
     """ Process event messages """
 
     print("Process Messages Function")
+
+    # A forked worker process must not share the parent's pooled connections, and needs its own log listener thread
+    if WORKER_CONFIG.get("mode", "thread") == "process":
+        DB_ENGINE.dispose()
+        setup_logging(log_config)
     
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
+    def setup(client):
+        """ Looks up the events topic and announces the service on the event_log topic """
 
-    current_retry = 0
-    max_retries = app_config["events"]["max_retries"]
+        # First Topic events
+        topic_one = client.topics[str.encode(app_config["events"]["topics"][0])]
 
-    while current_retry < max_retries:
-        try:
-            logger.info(f"Trying to connect to Kafka. Current retry count: {current_retry}")
-            client = KafkaClient(hosts=hostname)
-            # topic = client.topics[str.encode(app_config["events"]["topic"])]
-            
-            # First Topic events
-            first_topic = client.topics[str.encode(app_config["events"]["topics"][0])]
-
-            # Second Topic event_log
-            second_topic = client.topics[str.encode(app_config["events"]["topics"][1])]
-            second_producer = second_topic.get_sync_producer()
+        # Second Topic event_log
+        second_topic = client.topics[str.encode(app_config["events"]["topics"][1])]
+        if worker_id == 0:
+            second_producer = make_producer(second_topic, app_config.get("producer"))
             ready_msg = {
                 "message_info": f"Storage service successfully started and connected to Kafka. Ready to consume messages from the {app_config['events']['topics'][1]} topic.",
                 "message_code": "0002"
@@ -79,115 +111,227 @@ def process_messages():
             ready_msg_str = json.dumps(ready_msg)
             second_producer.produce(ready_msg_str.encode('utf-8'))
 
-            break
+        return topic_one
 
-        except:
-            logger.error("Connection failed.")
-            time.sleep(app_config["events"]["sleep_time"])
-            current_retry += 1
+    first_topic = connect(app_config["events"], logger, setup)
 
     print("Pass One!")
 
     # Create a consume on a consumer group, that only reads new messages (uncommitted messages) when the service re-starts 
     # (i.e., it doesn't read all the old messages from the history in the message queue).
     
-    consumer = first_topic.get_simple_consumer(consumer_group=b'event_group',
-                                         reset_offset_on_start=False,
-                                         auto_offset_reset=OffsetType.LATEST)
+    # The consumer times out after the linger time so a partially filled batch still gets written
+    batch_config = app_config.get("batch", {})
+    max_size = batch_config.get("max_size", 100)
+    linger_ms = batch_config.get("linger_ms", 500)
+
+    offset_store = OffsetStore("event_group", app_config["events"]["topics"][0]) if EXACTLY_ONCE else None
+
+    def stored_offsets(consumer, old_partition_offsets, new_partition_offsets):
+        """ After a rebalance, starts the newly assigned partitions after the offsets stored with the events """
+        offsets = offset_store.load(DB_SESSION)
+        return {partition_id: offsets[partition_id] for partition_id in new_partition_offsets if partition_id in offsets}
+
+    # With Kafka and ZooKeeper configured, every worker joins a balanced consumer group and is assigned its own partitions.
+    # The local backend has no group coordinator, so it always uses the static assignment below, even with zookeeper set.
+    if app_config["events"].get("backend", "kafka") == "kafka" and "zookeeper" in app_config["events"]:
+        consumer = first_topic.get_balanced_consumer(consumer_group=b'event_group',
+                                                     zookeeper_connect=app_config["events"]["zookeeper"],
+                                                     auto_commit_enable=False,
+                                                     reset_offset_on_start=False,
+                                                     auto_offset_reset=OffsetType.LATEST,
+                                                     consumer_timeout_ms=linger_ms,
+                                                     post_rebalance_callback=stored_offsets if EXACTLY_ONCE else None)
+    else:
+        # Otherwise worker i statically owns every partition p with p % workers == i
+        num_workers = WORKER_CONFIG.get("workers", 1)
+        partitions = [partition for partition_id, partition in first_topic.partitions.items() if partition_id % num_workers == worker_id]
+        consumer = first_topic.get_simple_consumer(consumer_group=b'event_group',
+                                             partitions=partitions,
+                                             reset_offset_on_start=False,
+                                             auto_offset_reset=OffsetType.LATEST,
+                                             consumer_timeout_ms=linger_ms)
+
+        # Seek straight to the last stored event of each partition, so nothing is rescanned or stored twice
+        if EXACTLY_ONCE:
+            offsets = offset_store.load(DB_SESSION)
+            consumer.reset_offsets([(partition, offsets[partition.id]) for partition in partitions if partition.id in offsets])
     
     print("Pass Two!")
 
-    # This is blocking - it will wait for a new message
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-        payload = msg["payload"]
-        # print(payload)
-
-
-        if msg["type"] == "hotel_room":  # Change this to your event type
-            # Store the event1 (i.e., the payload) to the DB
-            session = DB_SESSION()
-            hotel_room = HotelRoom(payload["hotel_id"],
-                                   payload["customer_id"],
-                                   payload["room_id"],
-                                   payload["room_type"],
-                                   payload["num_of_people"],
-                                   payload["check_in_date"],
-                                   payload["check_out_date"],
-                                   payload["timestamp"],
-                                   payload["trace_id"])
-            session.add(hotel_room)
-            logger.debug(f"Stored event Hotel Room Booking request with a trace id of {payload['trace_id']}")
-            session.commit()
-            session.close()
-
-        elif msg["type"] == "hotel_activity":  # Change this to your event type
-            # Store the event2 (i.e., the payload) to the DB
-            session = DB_SESSION()
-            hotel_activity = HotelActivity(payload["hotel_id"],
-                                           payload["customer_id"],
-                                           payload["activity_id"],
-                                           payload["activity_name"],
-                                           payload["num_of_people"],
-                                           payload["reservation_date"],
-                                           payload["timestamp"],
-                                           payload["trace_id"])
-            session.add(hotel_activity)
-            logger.debug(f"Stored event Hotel Activity Booking request with a trace id of {payload['trace_id']}")
-            session.commit()
-            session.close()
-
-        # Commit the new message as being read
-        consumer.commit_offsets()
-
-def get_hotel_room(start_timestamp, end_timestamp):
-    """ Gets new hotel room reservations between the start and end timestamps """
-    
-    session = DB_SESSION()
-
-    logger.info(f'Connecting to DB. Hostname: {app_config["datastore"]["hostname"]}, Port:{app_config["datastore"]["port"]}')
+    writer = BatchWriter(DB_SESSION, max_size=max_size, linger_ms=linger_ms, offset_store=offset_store)
+    consumed_at = []
+
+    # This is blocking - it will wait up to linger_ms for a new message
+    while True:
+        msg = consumer.consume()
+
+        if msg is not None:
+            partition_id, offset = msg.partition_id, msg.offset
+            # Both wire formats are read (event_codec.py)
+            msg = decode_message(msg.value)
+            writer.add(msg, partition_id, offset)
+            consumed_at.append(time.perf_counter())
+            if LOG_EVENT():
+                logger.info("Message: %s", msg)
+                logger.debug("Queued event %s with a trace id of %s", msg['type'], msg['payload']['trace_id'])
+
+        if writer.is_due():
+            # Store the whole batch in one transaction, then commit the offset of the last message in it
+            num_rows = writer.flush()
+            logger.debug("Worker %d stored a batch of %d events", worker_id, num_rows)
+
+            # Commit the batch of messages as being read
+            consumer.commit_offsets()
+
+            committed = time.perf_counter()
+            for consumed in consumed_at:
+                CONSUME_TO_COMMIT.observe(committed - consumed)
+            BATCH_SIZE.observe(num_rows)
+            consumed_at = []
+
+def stream_reservations(conn, result, model, name):
+    """ Streams the reservations as NDJSON and releases the database connection when done """
+    try:
+        for chunk in rows_to_ndjson(model, result, app_config.get("pagination", {}).get("yield_per", 1000)):
+            yield chunk
+    finally:
+        logger.debug("Streamed %s Reservations", name)
+        result.close()
+        conn.close()
+
+
+def get_reservations(model, name, start_timestamp, end_timestamp, limit, cursor, stream):
+    """ Gets the reservations of a model between the start and end timestamps, one page or one stream at a time """
+
+    logger.info('Connecting to DB. Hostname: %s, Port:%s', app_config["datastore"]["hostname"], app_config["datastore"]["port"])
 
     start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
     end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-    results = session.query(HotelRoom).filter(and_(HotelRoom.date_created >= start_timestamp_datetime, HotelRoom.date_created < end_timestamp_datetime))
-    results_list = []
 
+    # Pages are ordered on (date_created, id) and the cursor holds the last position that was returned
+    cursor_position = None
+    if cursor is not None:
+        try:
+            cursor_position = decode_cursor(cursor)
+        except (ValueError, TypeError):
+            return {"message": "Invalid cursor"}, 400
 
-    for reservation in results:
-        results_list.append(reservation.to_dict())
+    if stream:
+        statement = select_reservations(model, start_timestamp_datetime, end_timestamp_datetime,
+                                        cursor_position, limit, ordered=True)
+        conn = DB_ENGINE.connect()
+        result = conn.execution_options(stream_results=True).execute(statement)
+        return Response(stream_reservations(conn, result, model, name), mimetype="application/x-ndjson")
 
-    logger.debug("Query for Hotel Room Reservations after %s returns %d results" % (start_timestamp, len(results_list)))
-    session.close()
+    # Fetch one extra row to find out whether there is a next page
+    statement = select_reservations(model, start_timestamp_datetime, end_timestamp_datetime,
+                                    cursor_position, None if limit is None else limit + 1)
+    with DB_ENGINE.connect() as conn:
+        rows = conn.execute(statement).fetchall()
+
+    headers = {}
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1].date_created, rows[-1].id)
+
+    logger.debug("Query for %s Reservations after %s returns %d results", name, start_timestamp, len(rows))
 
-    return results_list, 200
+    return Response(rows_to_json(model, rows), status=200, headers=headers, mimetype="application/json")
 
-def get_hotel_activity(start_timestamp, end_timestamp):
+def get_hotel_room(start_timestamp, end_timestamp, limit=None, cursor=None, stream=False):
+    """ Gets new hotel room reservations between the start and end timestamps """
+
+    return get_reservations(HotelRoom, "Hotel Room", start_timestamp, end_timestamp, limit, cursor, stream)
+
+def get_hotel_activity(start_timestamp, end_timestamp, limit=None, cursor=None, stream=False):
     """ Gets new hotel activity reservations between the start and end timestamps """
 
+    return get_reservations(HotelActivity, "Hotel Activity", start_timestamp, end_timestamp, limit, cursor, stream)
+
+def get_booking_by_trace_id(trace_id):
+    """ Gets the hotel room or hotel activity reservation with a trace id """
+
     session = DB_SESSION()
 
-    logger.info(f'Connecting to DB. Hostname: {app_config["datastore"]["hostname"]}, Port:{app_config["datastore"]["port"]}')
+    # event_trace has the table and date_created of the event, so only one partition of one table is searched
+    booking = None
+    event_trace = session.query(EventTrace).filter(EventTrace.trace_id == trace_id).first()
+    if event_trace is not None and event_trace.event_type in EVENT_TABLES:
+        model = EVENT_TABLES[event_trace.event_type][0]
+        reservation = session.query(model).filter(
+            and_(model.trace_id == trace_id, model.date_created == event_trace.date_created)).first()
+        if reservation is not None:
+            booking = {"type": event_trace.event_type, "payload": reservation.to_dict()}
+
+    session.close()
+
+    if booking is None:
+        logger.info("No reservation with a trace id of %s", trace_id)
+        return {"message": "Not Found"}, 404
+
+    logger.info("Found %s reservation with a trace id of %s", booking["type"], trace_id)
+
+    return booking, 200
+
+def get_booking_summary(start_timestamp, end_timestamp):
+    """ Gets the number of reservations and the max number of people per reservation type between the start and end timestamps """
+
+    session = DB_SESSION()
 
     start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
     end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-    results = session.query(HotelActivity).filter(and_(HotelActivity.date_created >= start_timestamp_datetime, HotelActivity.date_created < end_timestamp_datetime))
-    results_list = []
 
-    for reservation in results:
-        results_list.append(reservation.to_dict())
+    # COUNT and MAX are computed by the database, so only two numbers per table leave it
+    num_hotel_rooms, max_hotel_room_ppl = session.query(func.count(HotelRoom.id), func.max(HotelRoom.num_of_people)).filter(
+        and_(HotelRoom.date_created >= start_timestamp_datetime, HotelRoom.date_created < end_timestamp_datetime)).one()
+    num_hotel_activities, max_hotel_activity_ppl = session.query(func.count(HotelActivity.id), func.max(HotelActivity.num_of_people)).filter(
+        and_(HotelActivity.date_created >= start_timestamp_datetime, HotelActivity.date_created < end_timestamp_datetime)).one()
 
-    logger.debug("Query for Hotel Activity Reservations after %s returns %d results" % (start_timestamp, len(results_list)))
     session.close()
 
-    return results_list, 200
+    summary = {
+        "num_hotel_room_reservations": num_hotel_rooms,
+        "max_hotel_room_ppl": max_hotel_room_ppl or 0,
+        "num_hotel_activity_reservations": num_hotel_activities,
+        "max_hotel_activity_ppl": max_hotel_activity_ppl or 0
+    }
+
+    logger.debug("Booking summary between %s and %s: %s", start_timestamp, end_timestamp, summary)
+
+    return summary, 200
 
 app = connexion.FlaskApp(__name__, specification_dir="")
-app.add_api("openapi.yaml", strict_validation=True, validate_responses=True)
+# Fraction of responses validated against the spec, per operationId (default 1.0, i.e. every response)
+api = app.add_api("openapi.yaml", strict_validation=True, validate_responses=True,
+                  validator_map={"response": sampled_response_validator(app_config.get("response_validation", {}))})
+init_metrics(app, api)
+
+def manage_partitions():
+    """ Creates the upcoming partitions of the event tables and removes the expired ones, every partitions.interval_sec """
+    while True:
+        try:
+            for change in maintain_configured(DB_ENGINE, PARTITION_CONFIG):
+                logger.info(change)
+        except:
+            logger.exception("Partition maintenance failed")
+        time.sleep(PARTITION_CONFIG.get("interval_sec", 3600))
+
+def start_workers():
+    """ Starts the configured number of consumer workers """
+    for worker_id in range(WORKER_CONFIG.get("workers", 1)):
+        if WORKER_CONFIG.get("mode", "thread") == "process":
+            worker = Process(target=process_messages, args=(worker_id,))
+            worker.daemon = True
+        else:
+            worker = Thread(target=process_messages, args=(worker_id,))
+            worker.setDaemon(True)
+        worker.start()
 
 if __name__ == "__main__":
-    t1 = Thread(target=process_messages)
-    t1.setDaemon(True)
-    t1.start()
+    start_workers()
+    if PARTITION_CONFIG:
+        partition_thread = Thread(target=manage_partitions)
+        partition_thread.setDaemon(True)
+        partition_thread.start()
     app.run(port=8090)
@@ -0,0 +1,142 @@
+import time
+import datetime
+
+from hotel_room import HotelRoom
+from hotel_activity import HotelActivity
+from event_trace import EventTrace
+
+
+# Columns copied from the event payload into each table (date_created is stamped on write)
+HOTEL_ROOM_FIELDS = ["hotel_id", "customer_id", "room_id", "room_type", "num_of_people",
+                     "check_in_date", "check_out_date", "timestamp", "trace_id"]
+HOTEL_ACTIVITY_FIELDS = ["hotel_id", "customer_id", "activity_id", "activity_name", "num_of_people",
+                         "reservation_date", "timestamp", "trace_id"]
+
+EVENT_TABLES = {
+    "hotel_room": (HotelRoom, HOTEL_ROOM_FIELDS),
+    "hotel_activity": (HotelActivity, HOTEL_ACTIVITY_FIELDS)
+}
+
+INSERT_TRACE = EventTrace.__table__.insert().prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite")
+
+
+def to_row(msg, date_created):
+    """ Converts a decoded event message into a (model, row) pair ready for a bulk insert """
+
+    if msg["type"] not in EVENT_TABLES:
+        return None, None
+
+    model, fields = EVENT_TABLES[msg["type"]]
+    payload = msg["payload"]
+
+    row = {field: payload[field] for field in fields}
+    row["date_created"] = date_created
+
+    return model, row
+
+
+def store_events(session, messages, date_created):
+    """
+    Inserts the events whose trace ids are not stored yet, and their trace ids. Returns the number of events inserted
+
+    It must be the first write of the session's transaction: when some trace ids were already stored, the transaction
+    is rolled back and the trace ids are inserted again one at a time.
+    """
+
+    # Group the rows by table so each table gets one executemany
+    rows_by_model = {}
+    traces = {}
+    for msg in messages:
+        model, row = to_row(msg, date_created)
+        if model is not None and row["trace_id"] not in traces:
+            rows_by_model.setdefault(model, []).append(row)
+            traces[row["trace_id"]] = {"trace_id": row["trace_id"], "event_type": msg["type"], "date_created": date_created}
+
+    if not traces:
+        return 0
+
+    # Insert-or-ignore, so a trace id that is already stored (a redelivered event) is skipped instead of failing the
+    # batch. A trace id another worker is inserting at the same time waits for that transaction, then is skipped too.
+    num_inserted = session.execute(INSERT_TRACE, list(traces.values())).rowcount
+
+    # Some were skipped: insert them one at a time instead, where each rowcount says whether the trace id is new
+    if num_inserted < len(traces):
+        session.rollback()
+        inserted = {trace_id for trace_id, trace in traces.items() if session.execute(INSERT_TRACE, trace).rowcount}
+        rows_by_model = {model: [row for row in rows if row["trace_id"] in inserted] for model, rows in rows_by_model.items()}
+        num_inserted = len(inserted)
+
+    for model, rows in rows_by_model.items():
+        if rows:
+            session.execute(model.__table__.insert(), rows)
+
+    return num_inserted
+
+
+def write_one(db_session, msg):
+    """ Stores a single event in its own transaction (the original per-message path) """
+
+    session = db_session()
+    num_rows = store_events(session, [msg], datetime.datetime.now())
+    session.commit()
+    session.close()
+
+    return num_rows
+
+
+class BatchWriter:
+    """ Collects event messages and writes them to the database in one transaction per batch """
+
+    def __init__(self, db_session, max_size=100, linger_ms=500, offset_store=None):
+        """ Initializes a batch writer. With an offset store, the consumer offsets are written with each batch """
+        self.db_session = db_session
+        self.max_size = max_size
+        self.linger_sec = linger_ms / 1000.0
+        self.offset_store = offset_store
+        self.messages = []
+        self.offsets = {}
+        self.started = None
+
+    def add(self, msg, partition_id=None, offset=None):
+        """ Adds a decoded event message, and where it was read from in the events topic, to the current batch """
+        if not self.messages:
+            self.started = time.monotonic()
+        self.messages.append(msg)
+        if partition_id is not None:
+            self.offsets[partition_id] = offset
+
+    def is_due(self):
+        """ True when the batch is full or its oldest message has waited longer than the linger time """
+        if not self.messages:
+            return False
+        if len(self.messages) >= self.max_size:
+            return True
+        return time.monotonic() - self.started >= self.linger_sec
+
+    def flush(self):
+        """ Bulk inserts the current batch per table in a single transaction and returns the number of rows written """
+
+        if not self.messages:
+            return 0
+
+        date_created = datetime.datetime.now()
+
+        # Events that were already stored are skipped, so they are not counted
+        session = self.db_session()
+        try:
+            num_rows = store_events(session, self.messages, date_created)
+            # The rows and the offset of the last message in the batch are committed together, or neither is
+            if self.offset_store is not None and self.offsets:
+                self.offset_store.save(session, self.offsets)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        self.messages = []
+        self.offsets = {}
+        self.started = None
+
+        return num_rows
@@ -0,0 +1,43 @@
+"""
+Benchmark: size on the wire and encode / decode time of the event messages in the json and compact formats
+
+Usage: python3 benchmark_event_codec.py [num_events]
+
+The events are hotel room and hotel activity messages like the ones produced by the receiver. "bytes" is the
+size of the message value as it is written to the events topic (before any producer compression), decode is what
+every consumer (storage, processing, audit_log) pays per message.
+"""
+import sys
+import time
+
+from benchmark_batch_writer import make_events
+from event_codec import encode_message, decode_message, FORMATS
+
+
+def main():
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    events = make_events(num_events)
+
+    print("%-8s %10s %12s %14s %14s" % ("format", "bytes/msg", "total MB", "encode us/msg", "decode us/msg"))
+
+    for wire_format in FORMATS:
+        start = time.perf_counter()
+        encoded = [encode_message(event, wire_format) for event in events]
+        encode_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for value in encoded:
+            decode_message(value)
+        decode_elapsed = time.perf_counter() - start
+
+        total_bytes = sum(len(value) for value in encoded)
+        print("%-8s %10.1f %12.2f %14.2f %14.2f" % (wire_format, total_bytes / num_events, total_bytes / 1e6,
+                                                    encode_elapsed / num_events * 1e6,
+                                                    decode_elapsed / num_events * 1e6))
+
+        # Both formats decode to the same message
+        assert decode_message(encoded[0]) == events[0]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Query time of the date_created range queries and the trace_id lookup as the tables grow, with and without the
+migration 2 indexes and the unique trace_id index of migration 3
+
+Usage: python3 benchmark_indexes.py [sizes] [db_url]
+    e.g. python3 benchmark_indexes.py 10000,100000,1000000,10000000
+
+The default database is a temporary SQLite file. Rows are one every 100 ms, so the window that processing asks for
+(the last 5 seconds) always holds ~50 rows no matter how large the table is.
+"""
+import os
+import sys
+import time
+import datetime
+import tempfile
+
+from sqlalchemy import create_engine
+from sqlalchemy import and_, func
+from sqlalchemy.orm import sessionmaker
+
+from hotel_room import HotelRoom
+from migrations import migrate
+
+ROW_INTERVAL = datetime.timedelta(milliseconds=100)
+WINDOW = datetime.timedelta(seconds=5)
+CHUNK_SIZE = 10000
+
+
+def fill(engine, num_rows, start):
+    """ Inserts num_rows hotel room rows with date_created spaced ROW_INTERVAL apart """
+    table = HotelRoom.__table__
+    for chunk_start in range(0, num_rows, CHUNK_SIZE):
+        rows = []
+        for i in range(chunk_start, min(chunk_start + CHUNK_SIZE, num_rows)):
+            rows.append({"hotel_id": "CA-%02d" % (i % 20),
+                         "customer_id": "d290f1ee-6c54-4b01-90e6-d701748f0851",
+                         "room_id": "A%03d" % (i % 1000),
+                         "room_type": "Single Bed",
+                         "num_of_people": i % 4 + 1,
+                         "check_in_date": "2023-08-08",
+                         "check_out_date": "2023-08-13",
+                         "timestamp": "2023-07-29T09:12:33.001Z",
+                         "date_created": start + i * ROW_INTERVAL,
+                         "trace_id": "trace-%d" % i})
+        engine.execute(table.insert(), rows)
+
+
+def time_queries(db_session, end, num_rows, repeat=20):
+    """ Median time of the range query and the summary query over the newest WINDOW of rows, and of a trace_id lookup """
+    window_filter = and_(HotelRoom.date_created >= end - WINDOW, HotelRoom.date_created < end)
+    range_times = []
+    summary_times = []
+    trace_times = []
+    for i in range(repeat):
+        session = db_session()
+
+        start = time.perf_counter()
+        rows = session.query(HotelRoom).filter(window_filter).all()
+        range_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        session.query(func.count(HotelRoom.id), func.max(HotelRoom.num_of_people)).filter(window_filter).one()
+        summary_times.append(time.perf_counter() - start)
+
+        # A different row each time, spread over the whole table
+        start = time.perf_counter()
+        session.query(HotelRoom).filter(HotelRoom.trace_id == "trace-%d" % (i * num_rows // repeat)).first()
+        trace_times.append(time.perf_counter() - start)
+
+        session.close()
+
+    range_times.sort()
+    summary_times.sort()
+    trace_times.sort()
+    return len(rows), range_times[repeat // 2], summary_times[repeat // 2], trace_times[repeat // 2]
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1].split(",")] if len(sys.argv) > 1 else [10000, 100000, 1000000]
+
+    if len(sys.argv) > 2:
+        db_url = sys.argv[2]
+    else:
+        db_url = "sqlite:///%s" % os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+
+    engine = create_engine(db_url)
+    db_session = sessionmaker(bind=engine)
+    start = datetime.datetime(2023, 1, 1)
+
+    print("%12s %12s %8s %16s %12s %12s" % ("rows", "indexes", "matched", "range query ms", "summary ms", "trace ms"))
+    for size in sizes:
+        migrate(engine, 0)
+        migrate(engine, 1)
+        fill(engine, size, start)
+        end = start + size * ROW_INTERVAL
+
+        for label, version in [("none", 1), ("migration 2", 2), ("migration 3", 3)]:
+            migrate(engine, version)
+            matched, range_time, summary_time, trace_time = time_queries(db_session, end, size)
+            print("%12d %12s %8d %16.3f %12.3f %12.3f"
+                  % (size, label, matched, range_time * 1000, summary_time * 1000, trace_time * 1000))
+
+    migrate(engine, 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Benchmark: storage consumer loop throughput with logging off, the original synchronous eager logging, and the
+queue-based lazy logging (every event, and 1% of events sampled)
+
+Usage: python3 benchmark_logging.py [num_events] [db_url]
+
+Each run decodes the encoded events, logs them the way the consumer loop does and writes them through a
+BatchWriter to a temporary SQLite file (or db_url). The handlers are the ones in log_conf.yml at DEBUG: a log
+file, plus the console handler writing to /dev/null. "loop" is the time the consumer thread spent, "total" also
+includes the time until the log listener thread had written every queued record.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import logging.config
+import tempfile
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from migrations import migrate
+from batch_writer import BatchWriter
+from benchmark_batch_writer import make_events
+from log_setup import setup_logging, EventSampler
+
+
+def log_config(log_dir, level):
+    """ The handlers of log_conf.yml, writing to a temporary log file and /dev/null """
+    return {
+        "version": 1,
+        "formatters": {"simple": {"format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s"}},
+        "handlers": {
+            "console": {"class": "logging.FileHandler", "level": "DEBUG", "formatter": "simple", "filename": os.devnull},
+            "file": {"class": "logging.FileHandler", "level": "DEBUG", "formatter": "simple",
+                     "filename": os.path.join(log_dir, "app_storage.log")}
+        },
+        "loggers": {"basicLogger": {"level": level, "handlers": ["console", "file"], "propagate": False}},
+        "root": {"level": "WARNING", "handlers": []}
+    }
+
+
+def eager_loop(db_session, encoded, logger):
+    """ The consumer loop body as it was: every event formatted with % and f-strings before the logging call """
+    writer = BatchWriter(db_session)
+    for msg_str in encoded:
+        msg = json.loads(msg_str)
+        logger.info("Message: %s" % msg)
+        writer.add(msg)
+        logger.debug(f"Queued event {msg['type']} with a trace id of {msg['payload']['trace_id']}")
+        if writer.is_due():
+            writer.flush()
+    writer.flush()
+
+
+def lazy_loop(db_session, encoded, logger, log_event):
+    """ The consumer loop body now: sampled per-event lines with lazy %s arguments """
+    writer = BatchWriter(db_session)
+    for msg_str in encoded:
+        msg = json.loads(msg_str)
+        writer.add(msg)
+        if log_event():
+            logger.info("Message: %s", msg_str)
+            logger.debug("Queued event %s with a trace id of %s", msg['type'], msg['payload']['trace_id'])
+        if writer.is_due():
+            writer.flush()
+    writer.flush()
+
+
+def wait_for_listener(logger):
+    """ Waits until the log listener thread took every queued record """
+    for handler in logger.handlers:
+        log_queue = getattr(handler, "queue", None)
+        while log_queue is not None and not log_queue.empty():
+            time.sleep(0.001)
+
+
+def main():
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    work_dir = tempfile.mkdtemp()
+
+    if len(sys.argv) > 2:
+        db_url = sys.argv[2]
+    else:
+        db_url = "sqlite:///%s" % os.path.join(work_dir, "benchmark.sqlite")
+
+    engine = create_engine(db_url)
+    db_session = sessionmaker(bind=engine)
+    encoded = [json.dumps(event) for event in make_events(num_events)]
+
+    runs = [
+        ("logging off", "WARNING", None),
+        ("sync, eager", "DEBUG", None),
+        ("queue, lazy", "DEBUG", 1.0),
+        ("queue, lazy, 1%", "DEBUG", 0.01)
+    ]
+
+    for label, level, sample_rate in runs:
+        migrate(engine, 0)
+        migrate(engine)
+
+        start = time.perf_counter()
+        if sample_rate is None:
+            logging.config.dictConfig(log_config(work_dir, level))
+            logger = logging.getLogger('basicLogger')
+            if level == "WARNING":
+                lazy_loop(db_session, encoded, logger, EventSampler(1.0))
+            else:
+                eager_loop(db_session, encoded, logger)
+        else:
+            logger = setup_logging(log_config(work_dir, level))
+            lazy_loop(db_session, encoded, logger, EventSampler(sample_rate))
+        loop_elapsed = time.perf_counter() - start
+        wait_for_listener(logger)
+        elapsed = time.perf_counter() - start
+
+        print("%-16s %8d events  loop %8.3f s %10.0f events/s  total %8.3f s %10.0f events/s"
+              % (label, num_events, loop_elapsed, num_events / loop_elapsed, elapsed, num_events / elapsed))
+
+    migrate(engine, 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Microbenchmark: rows/sec of the ORM read path vs. the column-projected Core read path of the storage GET endpoints
+
+Usage: python3 benchmark_serialization.py [num_rows] [db_url]
+
+ORM path:  session.query(Model) -> identity-mapped instances -> to_dict() per row -> json.dumps
+Core path: select(columns) -> plain tuples -> JSON bytes
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import tempfile
+
+from sqlalchemy import create_engine
+from sqlalchemy import and_
+from sqlalchemy.orm import sessionmaker
+
+from hotel_room import HotelRoom
+from migrations import migrate
+from batch_writer import BatchWriter
+from benchmark_batch_writer import make_events
+from reservation_reader import select_reservations, rows_to_json
+
+
+def orm_path(db_session, start, end):
+    """ The original read path """
+    session = db_session()
+    results = session.query(HotelRoom).filter(and_(HotelRoom.date_created >= start, HotelRoom.date_created < end))
+    results_list = []
+    for reservation in results:
+        results_list.append(reservation.to_dict())
+    body = json.dumps(results_list).encode('utf-8')
+    session.close()
+    return body
+
+
+def core_path(engine, start, end):
+    """ The column-projected read path """
+    with engine.connect() as conn:
+        rows = conn.execute(select_reservations(HotelRoom, start, end)).fetchall()
+    return rows_to_json(HotelRoom, rows)
+
+
+def best_of(function, repeat=5):
+    """ Fastest of repeat runs, in seconds """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    if len(sys.argv) > 2:
+        db_url = sys.argv[2]
+    else:
+        db_url = "sqlite:///%s" % os.path.join(tempfile.mkdtemp(), "benchmark.sqlite")
+
+    engine = create_engine(db_url)
+    db_session = sessionmaker(bind=engine)
+    migrate(engine, 0)
+    migrate(engine)
+
+    # Only hotel room events, so every row is in the queried table
+    writer = BatchWriter(db_session, max_size=10000)
+    for event in make_events(num_rows * 2)[::2]:
+        writer.add(event)
+        if writer.is_due():
+            writer.flush()
+    writer.flush()
+
+    start = datetime.datetime(2000, 1, 1)
+    end = datetime.datetime(2100, 1, 1)
+    assert json.loads(orm_path(db_session, start, end)) == json.loads(core_path(engine, start, end))
+
+    for label, function in [("ORM + to_dict", lambda: orm_path(db_session, start, end)),
+                            ("Core select", lambda: core_path(engine, start, end))]:
+        elapsed = best_of(function)
+        print("%-15s %8d rows %8.3f s %10.0f rows/s" % (label, num_rows, elapsed, num_rows / elapsed))
+
+    migrate(engine, 0)
+
+
+if __name__ == "__main__":
+    main()
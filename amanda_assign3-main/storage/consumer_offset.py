@@ -0,0 +1,32 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime
+from base import Base
+import datetime
+
+class ConsumerOffset(Base):
+    """ Consumer Offset """
+
+    __tablename__ = "consumer_offset"
+
+    consumer_group = Column(String(100), primary_key=True)
+    topic = Column(String(100), primary_key=True)
+    partition_id = Column(Integer, primary_key=True, autoincrement=False)
+    last_offset = Column(BigInteger, nullable=False)
+    date_updated = Column(DateTime, nullable=False)
+
+    def __init__(self, consumer_group, topic, partition_id, last_offset):
+        """ Initializes the stored offset of a partition """
+        self.consumer_group = consumer_group
+        self.topic = topic
+        self.partition_id = partition_id
+        self.last_offset = last_offset
+        self.date_updated = datetime.datetime.now()
+
+    def to_dict(self):
+        """ Dictionary Representation of a stored offset """
+        dict = {}
+        dict["consumer_group"] = self.consumer_group
+        dict["topic"] = self.topic
+        dict["partition_id"] = self.partition_id
+        dict["last_offset"] = self.last_offset
+
+        return dict
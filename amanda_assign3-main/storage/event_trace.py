@@ -0,0 +1,31 @@
+from sqlalchemy import Column, String, DateTime, Index
+from base import Base
+import datetime
+
+class EventTrace(Base):
+    """ Event Trace """
+
+    __tablename__ = "event_trace"
+    __table_args__ = (
+        # Expired trace ids are deleted by date_created
+        Index("ix_event_trace_date_created", "date_created"),
+    )
+
+    # The partitioned event tables cannot have a unique trace_id index, so this table keeps every stored trace id
+    trace_id = Column(String(250), primary_key=True)
+    event_type = Column(String(100), nullable=False)
+    date_created = Column(DateTime, nullable=False)
+
+    def __init__(self, trace_id, event_type, date_created=None):
+        """ Initializes the trace id of a stored event """
+        self.trace_id = trace_id
+        self.event_type = event_type
+        self.date_created = date_created or datetime.datetime.now()
+
+    def to_dict(self):
+        """ Dictionary Representation of a stored trace id """
+        dict = {}
+        dict["trace_id"] = self.trace_id
+        dict["event_type"] = self.event_type
+
+        return dict
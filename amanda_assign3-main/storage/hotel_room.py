@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Index
 from base import Base
 import datetime
 
@@ -6,6 +6,12 @@ class HotelRoom(Base):
     """ Hotel Room """
 
     __tablename__ = "hotel_room"
+    __table_args__ = (
+        # Covers the date_created range filter and the num_of_people aggregate of the summary query
+        Index("ix_hotel_room_date_created", "date_created", "num_of_people"),
+        # Point lookups by trace id (event_trace keeps them unique, which a partitioned table cannot)
+        Index("ix_hotel_room_trace_id", "trace_id"),
+    )
 
     id = Column(Integer, primary_key=True)
     hotel_id = Column(String(250), nullable=False)
@@ -0,0 +1,52 @@
+import atexit
+import queue
+import random
+import logging
+import logging.config
+from logging.handlers import QueueHandler, QueueListener
+
+
+class DeferredQueueHandler(QueueHandler):
+    """ Queues records unformatted, so the message is only built on the listener thread """
+
+    def prepare(self, record):
+        """ QueueHandler.prepare() formats the message in the calling thread, which is what this avoids """
+        return record
+
+
+def setup_logging(log_config, logger_name="basicLogger"):
+    """
+    Applies the logging configuration, then puts the logger's handlers behind a queue
+
+    Logging calls only append the record to an in-memory queue. A QueueListener thread formats the messages and
+    writes them to the configured handlers (log file, stdout). Since the %s arguments are formatted later, on that
+    thread, they must not be modified after the logging call.
+    """
+    logging.config.dictConfig(log_config)
+    logger = logging.getLogger(logger_name)
+
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    listener.start()
+
+    # Writes out whatever is still queued when the service stops
+    atexit.register(listener.stop)
+
+    return logger
+
+
+class EventSampler:
+    """ Decides which per-event log lines are written: a rate of 1.0 logs every event, 0.01 about one in a hundred """
+
+    def __init__(self, rate=1.0):
+        """ Initializes a sampler """
+        self.rate = rate
+
+    def __call__(self):
+        """ True when this event should be logged """
+        return self.rate >= 1.0 or random.random() < self.rate
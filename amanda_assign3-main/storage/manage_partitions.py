@@ -0,0 +1,54 @@
+"""
+Sets up, maintains and removes the storage database
+
+Usage: python3 manage_partitions.py [create|maintain|drop]
+
+- create (default): applies every migration that has not been applied yet, which partitions the event tables on
+  MySQL, then creates their partitions (replaces create_database.py)
+- maintain: creates the upcoming partitions and drops or archives the expired ones, as the storage service does
+  every partitions.interval_sec
+- drop: reverts every migration, dropping the tables (replaces drop_tables.py)
+"""
+import os
+import sys
+import yaml
+
+from sqlalchemy import create_engine
+
+from migrations import migrate
+from partition_manager import maintain_configured
+
+if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+    APP_CONF_FILE = "/config/app_conf.yml"
+else:
+    APP_CONF_FILE = "app_conf.yml"
+
+with open(APP_CONF_FILE, 'r') as f:
+    app_config = yaml.safe_load(f.read())
+
+PARTITION_CONFIG = app_config.get("partitions", {})
+
+DB_ENGINE = create_engine(
+    f'mysql+pymysql://{app_config["datastore"]["user"]}:{app_config["datastore"]["password"]}@{app_config["datastore"]["hostname"]}:{app_config["datastore"]["port"]}/{app_config["datastore"]["db"]}'
+    )
+
+
+def maintain_partitions():
+    """ Creates the upcoming partitions and removes the expired ones """
+    for change in maintain_configured(DB_ENGINE, PARTITION_CONFIG):
+        print(change)
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "create"
+
+    if command == "create":
+        migrate(DB_ENGINE)
+        maintain_partitions()
+    elif command == "maintain":
+        maintain_partitions()
+    elif command == "drop":
+        migrate(DB_ENGINE, 0)
+    else:
+        print(__doc__)
+        sys.exit(1)
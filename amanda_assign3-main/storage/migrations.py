@@ -0,0 +1,176 @@
+import datetime
+
+from sqlalchemy import Table, Column, Integer, DateTime, String, MetaData, Index
+from sqlalchemy import inspect, text, select, literal
+from sqlalchemy.schema import CreateTable
+
+from hotel_room import HotelRoom
+from hotel_activity import HotelActivity
+from consumer_offset import ConsumerOffset
+from event_trace import EventTrace
+from partition_manager import partition_table, unpartition_table
+
+
+# Tracks which migrations have been applied to the database
+metadata = MetaData()
+schema_version = Table("schema_version", metadata,
+                       Column("version", Integer, primary_key=True, autoincrement=False),
+                       Column("description", String(250), nullable=False),
+                       Column("applied_at", DateTime, nullable=False))
+
+EVENT_TABLES = [HotelRoom.__table__, HotelActivity.__table__]
+
+
+def create_index(conn, index):
+    """ Creates the index unless it already exists """
+    existing = [ix["name"] for ix in inspect(conn).get_indexes(index.table.name)]
+    if index.name not in existing:
+        index.create(conn)
+
+
+def drop_index(conn, index):
+    """ Drops the index if it exists """
+    existing = [ix["name"] for ix in inspect(conn).get_indexes(index.table.name)]
+    if index.name in existing:
+        index.drop(conn)
+
+
+# Version 1: the original hotel_room and hotel_activity tables
+def create_event_tables(conn):
+    """ Creates the event tables (without the indexes, which belong to later versions) """
+    for table in EVENT_TABLES:
+        if not conn.dialect.has_table(conn, table.name):
+            conn.execute(CreateTable(table))
+
+
+def drop_event_tables(conn):
+    """ Drops the event tables """
+    for table in EVENT_TABLES:
+        table.drop(conn, checkfirst=True)
+
+
+def model_index(table, name):
+    """ The index of the model with the given name """
+    return next(index for index in table.indexes if index.name == name)
+
+
+def trace_id_index(table, unique=False):
+    """ The trace_id index of a version, on a stand-in table so it does not become part of the model """
+    stand_in = Table(table.name, MetaData(), Column("trace_id", String(250)))
+    return Index("%s_%s_trace_id" % ("uq" if unique else "ix", table.name), stand_in.c.trace_id, unique=unique)
+
+
+# Version 2: indexes for the date_created range queries and trace_id lookups
+def create_event_indexes(conn):
+    """ Creates the date_created and trace_id indexes on the event tables """
+    for table in EVENT_TABLES:
+        create_index(conn, model_index(table, "ix_%s_date_created" % table.name))
+        create_index(conn, trace_id_index(table))
+
+
+def drop_event_indexes(conn):
+    """ Drops the date_created and trace_id indexes from the event tables """
+    for table in EVENT_TABLES:
+        drop_index(conn, model_index(table, "ix_%s_date_created" % table.name))
+        drop_index(conn, trace_id_index(table))
+
+
+# Version 3: trace_id is unique, so a redelivered event cannot be stored twice
+def create_unique_trace_ids(conn):
+    """ Removes duplicate events (keeping the first one stored) and replaces the trace_id index with a unique one """
+    for table in EVENT_TABLES:
+        # The derived table lets MySQL delete from the table the subquery reads
+        conn.execute(text("DELETE FROM %s WHERE id NOT IN "
+                          "(SELECT id FROM (SELECT MIN(id) AS id FROM %s GROUP BY trace_id) AS first_stored)"
+                          % (table.name, table.name)))
+        create_index(conn, trace_id_index(table, unique=True))
+        drop_index(conn, trace_id_index(table))
+
+
+def drop_unique_trace_ids(conn):
+    """ Replaces the unique trace_id index with the non-unique one of version 2 """
+    for table in EVENT_TABLES:
+        create_index(conn, trace_id_index(table))
+        drop_index(conn, trace_id_index(table, unique=True))
+
+
+# Version 4: consumer offsets stored in the same transaction as the events
+def create_offset_table(conn):
+    """ Creates the consumer_offset table """
+    ConsumerOffset.__table__.create(conn, checkfirst=True)
+
+
+def drop_offset_table(conn):
+    """ Drops the consumer_offset table """
+    ConsumerOffset.__table__.drop(conn, checkfirst=True)
+
+
+# Version 5: event tables partitioned by date_created on MySQL, with their trace ids kept unique in event_trace
+def partition_event_tables(conn):
+    """ Moves the trace id uniqueness into event_trace, then partitions the event tables (MySQL only) """
+    event_trace = EventTrace.__table__
+    event_trace.create(conn, checkfirst=True)
+    for table in EVENT_TABLES:
+        copy = event_trace.insert().from_select(["trace_id", "event_type", "date_created"],
+                                                select([table.c.trace_id, literal(table.name), table.c.date_created]))
+        conn.execute(copy.prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite"))
+
+    # A partitioned table cannot have a unique index without the partitioning column
+    drop_unique_trace_ids(conn)
+
+    if conn.dialect.name == "mysql":
+        for table in EVENT_TABLES:
+            partition_table(conn, table.name)
+
+
+def unpartition_event_tables(conn):
+    """ Removes the partitions and makes trace_id unique in the event tables again """
+    if conn.dialect.name == "mysql":
+        for table in EVENT_TABLES:
+            unpartition_table(conn, table.name)
+
+    create_unique_trace_ids(conn)
+    EventTrace.__table__.drop(conn, checkfirst=True)
+
+
+# (version, description, upgrade, downgrade) in the order they are applied
+MIGRATIONS = [
+    (1, "create hotel_room and hotel_activity", create_event_tables, drop_event_tables),
+    (2, "index date_created and trace_id", create_event_indexes, drop_event_indexes),
+    (3, "make trace_id unique", create_unique_trace_ids, drop_unique_trace_ids),
+    (4, "create consumer_offset", create_offset_table, drop_offset_table),
+    (5, "partition event tables by date_created", partition_event_tables, unpartition_event_tables),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    """ Returns the highest applied migration version (0 for an empty database) """
+    schema_version.create(conn, checkfirst=True)
+    versions = [row[0] for row in conn.execute(schema_version.select())]
+    return max(versions) if versions else 0
+
+
+def migrate(engine, target=LATEST_VERSION):
+    """ Upgrades or downgrades the database to the target version. Running it again is a no-op """
+
+    with engine.connect() as conn:
+        version = current_version(conn)
+
+        for migration_version, description, upgrade, _ in MIGRATIONS:
+            if version < migration_version <= target:
+                upgrade(conn)
+                conn.execute(schema_version.insert(), {"version": migration_version,
+                                                       "description": description,
+                                                       "applied_at": datetime.datetime.now()})
+                print("Applied migration %d: %s" % (migration_version, description))
+
+        for migration_version, description, _, downgrade in reversed(MIGRATIONS):
+            if target < migration_version <= version:
+                downgrade(conn)
+                conn.execute(schema_version.delete().where(schema_version.c.version == migration_version))
+                print("Reverted migration %d: %s" % (migration_version, description))
+
+        if target == 0:
+            schema_version.drop(conn, checkfirst=True)
@@ -0,0 +1,45 @@
+import datetime
+
+from sqlalchemy import and_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from consumer_offset import ConsumerOffset
+
+
+def upsert_offsets(dialect_name):
+    """ Insert statement that overwrites the stored offset of a partition that already has one """
+    table = ConsumerOffset.__table__
+    if dialect_name == "mysql":
+        statement = mysql_insert(table)
+        return statement.on_duplicate_key_update(last_offset=statement.inserted.last_offset,
+                                                 date_updated=statement.inserted.date_updated)
+    return table.insert().prefix_with("OR REPLACE", dialect="sqlite")
+
+
+class OffsetStore:
+    """ Consumer offsets of one topic and consumer group, kept in the database next to the events """
+
+    def __init__(self, consumer_group, topic):
+        """ Initializes an offset store """
+        self.consumer_group = consumer_group
+        self.topic = topic
+
+    def load(self, db_session):
+        """ Last stored offset of each partition """
+        session = db_session()
+        rows = session.query(ConsumerOffset.partition_id, ConsumerOffset.last_offset).filter(
+            and_(ConsumerOffset.consumer_group == self.consumer_group, ConsumerOffset.topic == self.topic)).all()
+        session.close()
+
+        return {partition_id: last_offset for partition_id, last_offset in rows}
+
+    def save(self, session, offsets):
+        """ Stores the last offset of each partition as part of the session's transaction (the caller commits) """
+        date_updated = datetime.datetime.now()
+        rows = [{"consumer_group": self.consumer_group,
+                 "topic": self.topic,
+                 "partition_id": partition_id,
+                 "last_offset": last_offset,
+                 "date_updated": date_updated} for partition_id, last_offset in offsets.items()]
+
+        session.execute(upsert_offsets(session.get_bind().dialect.name), rows)
@@ -0,0 +1,165 @@
+"""
+Partitions of the event tables by date_created, and their retention
+
+On MySQL, hotel_room and hotel_activity are RANGE partitioned on TO_DAYS(date_created) (migration 5), with one
+partition per day or per month and a p_max partition for everything after the newest one. maintain() splits the
+partitions of the coming periods off p_max, and drops (or archives into tables of their own) the partitions whose
+rows are all older than the retention window. Range queries on date_created only read the partitions of their
+window.
+
+Other databases (SQLite in development and the benchmarks) have no partitions, so maintain() only deletes the rows
+that are older than the retention window.
+"""
+import datetime
+
+from sqlalchemy import text
+
+from hotel_room import HotelRoom
+from hotel_activity import HotelActivity
+from event_trace import EventTrace
+
+EVENT_TABLES = [HotelRoom.__table__, HotelActivity.__table__]
+
+PERIODS = ("daily", "monthly")
+
+
+def add_periods(start, period, count):
+    """ Start of the period count periods after (or before, when negative) the period starting at start """
+    if period == "monthly":
+        months = start.year * 12 + start.month - 1 + count
+        return datetime.date(months // 12, months % 12 + 1, 1)
+    return start + datetime.timedelta(days=count)
+
+
+def period_start(day, period):
+    """ First day of the period a date falls in """
+    return day.replace(day=1) if period == "monthly" else day
+
+
+def to_days(day):
+    """ Same value as MySQL's TO_DAYS(), the day number the partitions are bounded by """
+    return day.toordinal() + 365
+
+
+def partition_name(start, period):
+    """ Name of the partition of the period starting at start (e.g. p20240131 or p202401) """
+    return "p" + start.strftime("%Y%m" if period == "monthly" else "%Y%m%d")
+
+
+def existing_partitions(conn, table_name):
+    """ (name, upper bound) of each partition of a table in order, the bound being None for p_max """
+    rows = conn.execute(text("SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+                             "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name "
+                             "AND PARTITION_NAME IS NOT NULL ORDER BY PARTITION_ORDINAL_POSITION"),
+                        table_name=table_name).fetchall()
+    return [(name, None if bound == "MAXVALUE" else int(bound)) for name, bound in rows]
+
+
+def partition_table(conn, table_name):
+    """ Turns a table into a RANGE partitioned one with only p_max, which maintain() splits into periods """
+
+    # Every unique key of a partitioned table must contain the partitioning column
+    conn.execute(text("ALTER TABLE %s DROP PRIMARY KEY, ADD PRIMARY KEY (id, date_created)" % table_name))
+    conn.execute(text("ALTER TABLE %s PARTITION BY RANGE (TO_DAYS(date_created)) "
+                      "(PARTITION p_max VALUES LESS THAN MAXVALUE)" % table_name))
+
+
+def unpartition_table(conn, table_name):
+    """ Turns a partitioned table back into a plain one, keyed by id alone """
+    conn.execute(text("ALTER TABLE %s REMOVE PARTITIONING" % table_name))
+    conn.execute(text("ALTER TABLE %s DROP PRIMARY KEY, ADD PRIMARY KEY (id)" % table_name))
+
+
+def create_partitions(conn, table_name, partitions, first_start, last_start, period):
+    """ Splits the partitions of the periods from first_start to last_start off p_max. Returns their names """
+
+    # The new partitions start where the newest existing one ends
+    newest_bound = max([bound for _, bound in partitions if bound is not None] or [0])
+
+    definitions = []
+    if not newest_bound:
+        # Partitioning the table for the first time: every row before the retention window goes into p_old
+        definitions.append(("p_old", to_days(first_start)))
+
+    start = first_start
+    while start <= last_start:
+        end = add_periods(start, period, 1)
+        if to_days(end) > newest_bound:
+            definitions.append((partition_name(start, period), to_days(end)))
+        start = end
+
+    if definitions:
+        # p_max is empty once the current period has a partition, so reorganizing it only changes the metadata
+        conn.execute(text("ALTER TABLE %s REORGANIZE PARTITION p_max INTO (%s, PARTITION p_max VALUES LESS THAN MAXVALUE)"
+                          % (table_name, ", ".join("PARTITION %s VALUES LESS THAN (%d)" % definition
+                                                   for definition in definitions))))
+
+    return [name for name, _ in definitions]
+
+
+def remove_partitions(conn, table_name, partitions, cutoff, archive):
+    """ Drops (or archives) every partition whose rows are all older than the cutoff date. Returns their names """
+
+    names = [name for name, bound in partitions if bound is not None and bound <= to_days(cutoff)]
+    for name in names:
+        if archive:
+            # The partition's rows are swapped into an empty table of the same structure, which keeps them
+            archive_name = "%s_%s" % (table_name, name)
+            conn.execute(text("CREATE TABLE %s LIKE %s" % (archive_name, table_name)))
+            conn.execute(text("ALTER TABLE %s REMOVE PARTITIONING" % archive_name))
+            conn.execute(text("ALTER TABLE %s EXCHANGE PARTITION %s WITH TABLE %s" % (table_name, name, archive_name)))
+        conn.execute(text("ALTER TABLE %s DROP PARTITION %s" % (table_name, name)))
+
+    return names
+
+
+def maintain(engine, period="daily", future=7, retention=90, archive=False, today=None):
+    """
+    Creates the partitions of the current and next `future` periods, and removes the rows of the periods before the
+    last `retention` ones. Returns a description of each change
+    """
+
+    if period not in PERIODS:
+        raise ValueError("Unknown partition period %s, expected one of %s" % (period, ", ".join(PERIODS)))
+
+    current = period_start(today or datetime.date.today(), period)
+    cutoff = add_periods(current, period, -retention)
+    cutoff_datetime = datetime.datetime.combine(cutoff, datetime.time())
+    changes = []
+
+    with engine.connect() as conn:
+        for table in EVENT_TABLES:
+            if conn.dialect.name != "mysql":
+                # No partitions, so the expired rows are deleted one by one
+                result = conn.execute(table.delete().where(table.c.date_created < cutoff_datetime))
+                if result.rowcount:
+                    changes.append("Deleted %d %s rows created before %s" % (result.rowcount, table.name, cutoff))
+                continue
+
+            partitions = existing_partitions(conn, table.name)
+            if not partitions:
+                changes.append("%s is not partitioned, apply the migrations first" % table.name)
+                continue
+
+            for name in create_partitions(conn, table.name, partitions, cutoff, add_periods(current, period, future), period):
+                changes.append("Created partition %s of %s" % (name, table.name))
+
+            for name in remove_partitions(conn, table.name, existing_partitions(conn, table.name), cutoff, archive):
+                changes.append("%s partition %s of %s" % ("Archived" if archive else "Dropped", name, table.name))
+
+        # Trace ids of expired events can no longer be looked up or redelivered
+        event_traces = EventTrace.__table__
+        result = conn.execute(event_traces.delete().where(event_traces.c.date_created < cutoff_datetime))
+        if result.rowcount:
+            changes.append("Deleted %d trace ids of events created before %s" % (result.rowcount, cutoff))
+
+    return changes
+
+
+def maintain_configured(engine, partition_config):
+    """ maintain() with the settings of the partitions section of app_conf.yml """
+    return maintain(engine,
+                    period=partition_config.get("period", "daily"),
+                    future=partition_config.get("future", 7),
+                    retention=partition_config.get("retention", 90),
+                    archive=partition_config.get("action", "drop") == "archive")
@@ -0,0 +1,69 @@
+import json
+import base64
+import datetime
+
+from sqlalchemy import select
+from sqlalchemy import and_, or_
+
+from batch_writer import EVENT_TABLES
+
+
+# Only the columns that go into the response are selected, plus id/date_created for the pagination cursor
+RESPONSE_FIELDS = {model: fields for model, fields in EVENT_TABLES.values()}
+
+
+def encode_cursor(date_created, row_id):
+    """ Opaque pagination cursor for the position right after the given row """
+    position = json.dumps([date_created.strftime("%Y-%m-%dT%H:%M:%S.%f"), row_id])
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    """ Returns the (date_created, id) position stored in a pagination cursor """
+    date_created, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+    return datetime.datetime.strptime(date_created, "%Y-%m-%dT%H:%M:%S.%f"), int(row_id)
+
+
+def select_reservations(model, start, end, cursor_position=None, limit=None, ordered=False):
+    """ Core select of the response columns (as plain tuples, no ORM instances) between start and end """
+
+    table = model.__table__
+    columns = [table.c[field] for field in RESPONSE_FIELDS[model]] + [table.c.date_created, table.c.id]
+
+    statement = select(columns).where(and_(table.c.date_created >= start, table.c.date_created < end))
+
+    if cursor_position is not None:
+        cursor_date_created, cursor_id = cursor_position
+        statement = statement.where(or_(table.c.date_created > cursor_date_created,
+                                        and_(table.c.date_created == cursor_date_created, table.c.id > cursor_id)))
+
+    if ordered or cursor_position is not None or limit is not None:
+        statement = statement.order_by(table.c.date_created, table.c.id)
+
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    return statement
+
+
+def rows_to_dicts(model, rows):
+    """ Pairs the selected column values with the response field names """
+    fields = RESPONSE_FIELDS[model]
+    num_fields = len(fields)
+    return [dict(zip(fields, row[:num_fields])) for row in rows]
+
+
+def rows_to_json(model, rows):
+    """ Serializes selected rows straight to the JSON array body of the response """
+    return json.dumps(rows_to_dicts(model, rows)).encode('utf-8')
+
+
+def rows_to_ndjson(model, result, batch_size):
+    """ Yields the selected rows as NDJSON, fetching batch_size rows from the database at a time """
+    fields = RESPONSE_FIELDS[model]
+    num_fields = len(fields)
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        yield "".join(json.dumps(dict(zip(fields, row[:num_fields]))) + "\n" for row in rows)